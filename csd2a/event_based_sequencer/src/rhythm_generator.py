@@ -12,7 +12,7 @@ NOTE: For this program to work, three audio files should be present in
 ../assets. These files should be called kick.wav, snare.wav and hat.wav.
 """
 from sequencer import Sequencer
-import simpleaudio as sa
+from sample_cache import load_wave_object
 from random import random
 
 
@@ -28,7 +28,7 @@ def generate_high_pattern(sequencer, length):
     """
     Generate a hihat pattern. The hihat pattern is mostly random.
     """
-    audio_file = sa.WaveObject.from_wave_file("../assets/hat.wav")
+    audio_file = load_wave_object("../assets/hat.wav")
     track = sequencer.add_track(length, audio_file, "kick")
 
     for i in range(16):
@@ -42,7 +42,7 @@ def generate_mid_pattern(sequencer, length):
     played on the 2nd or 4th beat, and has a 50% chance to containe one snare
     that is played a sixteenth note early.
     """
-    audio_file = sa.WaveObject.from_wave_file("../assets/snare.wav")
+    audio_file = load_wave_object("../assets/snare.wav")
     track = sequencer.add_track(length, audio_file, "snare")
     offset_snare_present = False
 
@@ -57,7 +57,7 @@ def generate_low_pattern(sequencer, length):
     Generate a kick pattern. A kick is always played on the first sixteenth of
     a measure.
     """
-    audio_file = sa.WaveObject.from_wave_file("../assets/kick.wav")
+    audio_file = load_wave_object("../assets/kick.wav")
     track = sequencer.add_track(length, audio_file, "kick")
 
     for i in range(16):
@@ -0,0 +1,73 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+sample_cache.py:
+Contains a cache that makes sure every audio file is only loaded once, so all
+tracks that use the same file share its audio data.
+"""
+import simpleaudio as sa
+from collections import OrderedDict
+from os.path import getmtime
+
+
+class SampleCache:
+    """
+    A sample cache keeps the WaveObjects of recently used audio files in
+    memory. WaveObjects are identified by the path and modification time of
+    their audio file, so a file is reloaded when it changes. When the cached
+    audio takes up more than max_size bytes, the least recently used
+    WaveObjects are removed.
+    """
+
+    def __init__(self, max_size=256 * 1024 * 1024):
+        """
+        Initialize an empty cache that holds at most max_size bytes of audio.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.wave_objects = OrderedDict()
+
+    def get(self, file_path):
+        """
+        Return the WaveObject for the given audio file. Load it if it is not
+        in the cache yet.
+        """
+        key = (file_path, getmtime(file_path))
+
+        if key in self.wave_objects:
+            self.wave_objects.move_to_end(key)
+            return self.wave_objects[key]
+
+        # Remove audio loaded from an older version of the file.
+        for old_key in [
+            old_key for old_key in self.wave_objects if old_key[0] == file_path
+        ]:
+            self.remove(old_key)
+
+        wave_object = sa.WaveObject.from_wave_file(file_path)
+        self.wave_objects[key] = wave_object
+        self.size += len(wave_object.audio_data)
+
+        # Always keep the requested file, even if it is larger than max_size.
+        while len(self.wave_objects) > 1 and self.size > self.max_size:
+            self.remove(next(iter(self.wave_objects)))
+
+        return wave_object
+
+    def remove(self, key):
+        """
+        Remove the WaveObject with the given key from the cache.
+        """
+        self.size -= len(self.wave_objects.pop(key).audio_data)
+
+
+# The cache shared by all tracks in this process.
+sample_cache = SampleCache()
+
+
+def load_wave_object(file_path):
+    """
+    Load the WaveObject for the given audio file from the shared sample cache.
+    """
+    return sample_cache.get(file_path)
@@ -7,24 +7,32 @@ On:             October 6, 2023
 sequencer.py:
 Implement all classes necessary to run a sequencer.
 """
-import simpleaudio as sa
 import threading
 import time
+from array import array
+from bisect import bisect_left
+from math import lcm
 from helpers import (
     str_is_int_gt_zero,
     note_duration_valid,
     durations_to_timestamps_16th,
 )
 from os.path import isfile
-from queue import Queue
+from queue import Empty, Queue
+from sample_cache import load_wave_object
 
 
 class NoteEvent:
     """
     Note events hold all relevant information on rhythmic notes, such as
-    velocity, timestamp and duration.
+    velocity, timestamp and duration. Tracks store their notes in arrays (see
+    SequencerTrack), and only create note events when they are asked for a
+    note. A note event is a copy of a note: changing it does not change the
+    track.
     """
 
+    __slots__ = ["track", "timestamp", "duration", "velocity"]
+
     def __init__(self, track, timestamp, duration, velocity):
         """
         Initialize a note object given the timestamp in 16th notes, the audio
@@ -79,49 +87,92 @@ class SequencerTrack:
         """
         self.sequencer = sequencer
         self.length = length
-        self.note_events = []
+        # The timestamps, durations and velocities of the notes are stored in
+        # separate arrays, sorted by timestamp, which takes far less memory
+        # than a NoteEvent object per note.
+        self.timestamps = array("d")
+        self.durations = array("d")
+        self.velocities = array("B")
         self.audio_file = audio_file
-        self.note_index = 0
-        self.sixteenth_index = 0
         self.name = name
 
     def __str__(self):
         return self.name + " track"
 
+    def get_note(self, index):
+        """
+        Return a note event for the note at the given index.
+        """
+        return NoteEvent(
+            self,
+            self.timestamps[index],
+            self.durations[index],
+            self.velocities[index],
+        )
+
+    def get_notes(self):
+        """
+        Yield a note event for every note, in order of their timestamps.
+        """
+        for index in range(len(self.timestamps)):
+            yield self.get_note(index)
+
+    def find_note(self, timestamp):
+        """
+        Return the index of the note at the given timestamp, or None if there
+        is no note at that timestamp.
+        """
+        index = bisect_left(self.timestamps, timestamp)
+
+        if index < len(self.timestamps) and self.timestamps[index] == timestamp:
+            return index
+
+        return None
+
     def add_note(self, timestamp, duration, velocity, replace=False):
         """
-        Add a note event. If a note event exists at the given timestamp and
-        replace is False, do not insert the new note event. If replace is True,
-        replace the old note event with the new note event.
+        Add a note. If a note exists at the given timestamp and replace is
+        False, do not insert the new note. If replace is True, replace the old
+        note with the new note. The position of the note is found by
+        bisecting, so the notes stay sorted without sorting them again.
         """
+        index = self.find_note(timestamp)
 
-        if any(note_event.timestamp == timestamp for note_event in self.note_events):
+        if index is not None:
             if replace:
-                self.note_events = list(
-                    filter(
-                        lambda note_event: note_event.timestamp != timestamp,
-                        self.note_events,
-                    )
-                )
-            else:
-                return
+                self.durations[index] = duration
+                self.velocities[index] = velocity
+                self.sequencer.dispatch_table = None
+
+            return
 
-        note_event = NoteEvent(self, timestamp, duration, velocity)
-        self.note_events.append(note_event)
-        self.note_events.sort()
+        index = bisect_left(self.timestamps, timestamp)
+        self.timestamps.insert(index, timestamp)
+        self.durations.insert(index, duration)
+        self.velocities.insert(index, velocity)
+        self.sequencer.dispatch_table = None
 
-    def step(self):
+    def remove_note(self, timestamp):
         """
-        Step the sequencer track one sixteenth.
+        Remove the note at the given timestamp, if there is one.
         """
-        self.sixteenth_index = (self.sixteenth_index + 1) % self.length
+        index = self.find_note(timestamp)
 
-        if self.note_events[self.note_index].timestamp == self.sixteenth_index:
-            self.note_events[self.note_index].play()
-            self.note_index = (self.note_index + 1) % len(self.note_events)
+        if index is not None:
+            del self.timestamps[index]
+            del self.durations[index]
+            del self.velocities[index]
+            self.sequencer.dispatch_table = None
 
-        if self.note_events[self.note_index].timestamp >= self.length:
-            self.note_index = 0
+    def set_notes(self, timestamps, duration=1, velocity=100):
+        """
+        Replace all notes with notes at the given timestamps, all with the
+        same duration and velocity.
+        """
+        self.timestamps = array(self.timestamps.typecode, sorted(set(timestamps)))
+        self.durations = array("d", [duration]) * len(self.timestamps)
+        self.velocities = array("B", [velocity]) * len(self.timestamps)
+        self.sequencer.dispatch_table = None
 
 
 class Sequencer:
@@ -139,6 +190,9 @@ class Sequencer:
         self.bpm = 120
         self.sixteenth_duration = 15 / self.bpm
         self.queue = Queue()
+        # The note events to play at each sixteenth of the cycle, see
+        # compile_dispatch_table. None when it has to be compiled again.
+        self.dispatch_table = None
 
     def set_bpm(self, bpm):
         """
@@ -153,8 +207,32 @@ class Sequencer:
         """
         track = SequencerTrack(self, length, audio_file, name)
         self.tracks.append(track)
+        self.dispatch_table = None
         return track
 
+    def compile_dispatch_table(self):
+        """
+        Compile the notes of all tracks into a table with the note events to
+        play at each sixteenth. Tracks can have different lengths, so the
+        table covers the least common multiple of their lengths, after which
+        all tracks start their loop at the same time again. Notes are played
+        at the nearest sixteenth.
+        """
+        cycle_length = lcm(*[track.length for track in self.tracks])
+        table = [[] for _ in range(cycle_length)]
+
+        for track in self.tracks:
+            for note_event in track.get_notes():
+                sixteenth = round(note_event.timestamp)
+
+                if sixteenth >= track.length:
+                    continue
+
+                for i in range(sixteenth, cycle_length, track.length):
+                    table[i].append(note_event)
+
+        self.dispatch_table = [tuple(note_events) for note_events in table]
+
     def bpm_input(self):
         """
         Display the default bpm to the user. If the user wishes to change it, get
@@ -208,7 +286,7 @@ class Sequencer:
         while not (isfile(path) and path.endswith(".wav")):
             path = input("Path to the sample to be played: (should be a .wav file)\n>")
 
-        return sa.WaveObject.from_wave_file(path)
+        return load_wave_object(path)
 
     def notes_input(self):
         """
@@ -226,8 +304,7 @@ class Sequencer:
             while name == "":
                 name = input("Enter this part's name\n>")
 
-            track = SequencerTrack(self, 16, audio_file, name)
-            self.tracks.append(track)
+            track = self.add_track(16, audio_file, name)
 
             for i in range(len(rhythm)):
                 track.add_note(timestamps_16th[i], rhythm[i], 100)
@@ -256,33 +333,44 @@ class Sequencer:
 
     def play(self):
         """
-        Play a rhythm using the given timestamps.
+        Play a rhythm using the given timestamps. Every sixteenth note has an
+        absolute deadline on the monotonic clock. Until the next deadline, the
+        loop waits for a command, so it wakes up either for the next sixteenth
+        or as soon as a command arrives. The notes of each sixteenth are looked
+        up in the dispatch table, which is compiled again when a track changes.
         """
-        start_time = time.time()
+        start_time = time.monotonic()
         done = False
         n_sixteenths = 0
+        position = 0  # Position in the dispatch table's cycle.
 
         while not done:
-            time_since_start = time.time() - start_time
-
-            try:
-                command = self.queue.get(block=False)
-            except:
-                command = None
-
-            if command == "stop":
-                done = True
-            elif isinstance(command, int):
-                self.bpm = command
-                start_time = time.time() + 0.001
-                n_sixteenths = 1
+            deadline = start_time + n_sixteenths * self.sixteenth_duration
+            timeout = deadline - time.monotonic()
+
+            if timeout > 0:
+                try:
+                    command = self.queue.get(timeout=timeout)
+                except Empty:
+                    continue
+
+                if command == "stop":
+                    done = True
+                elif isinstance(command, int):
+                    self.set_bpm(command)
+                    start_time = time.monotonic()
+                    n_sixteenths = 1
+
                 continue
 
-            if time_since_start - n_sixteenths * self.sixteenth_duration > 0:
-                [track.step() for track in self.tracks]
-                n_sixteenths += 1
-            else:
-                time.sleep(0.001)
+            if self.dispatch_table is None:
+                self.compile_dispatch_table()
+
+            for note_event in self.dispatch_table[position % len(self.dispatch_table)]:
+                note_event.play()
+
+            position += 1
+            n_sixteenths += 1
 
     def start(self):
         """
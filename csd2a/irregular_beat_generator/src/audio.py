@@ -0,0 +1,201 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+audio.py:
+Contains functions to convert audio to NumPy arrays, mix it and write it to a
+WAV file.
+"""
+import numpy as np
+import struct
+import wave
+from math import ceil
+from os.path import getsize
+
+# The format in which audio is mixed and rendered.
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # Bytes per sample of audio files in this format.
+
+# The number of different gains velocities are mapped to.
+VELOCITY_STEPS = 16
+
+# Format tags of uncompressed PCM WAV files.
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def velocity_to_gain(velocity):
+    """
+    Return the gain for the given MIDI velocity (0 to 127). Velocities are
+    rounded up to one of VELOCITY_STEPS steps, so only a few differently
+    scaled copies of a sample are ever needed.
+    """
+    step = ceil(min(max(velocity, 0), 127) * VELOCITY_STEPS / 127)
+    return step / VELOCITY_STEPS
+
+
+def map_wave_file(file_path):
+    """
+    Memory-map the PCM data of a WAV file. Return a read-only uint8 NumPy
+    array backed by the file, the number of channels, the number of bytes per
+    sample and the sample rate. The data is only read from disk when it is
+    accessed, so mapping a file is fast regardless of its size.
+    """
+    file_size = getsize(file_path)
+    fmt = None
+
+    with open(file_path, "rb") as wave_file:
+        riff, _, wave_id = struct.unpack("<4sI4s", wave_file.read(12))
+
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise Exception('"{}" is not a WAV file.'.format(file_path))
+
+        while True:
+            header = wave_file.read(8)
+
+            if len(header) < 8:
+                raise Exception('No audio data found in "{}".'.format(file_path))
+
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", wave_file.read(16))
+                wave_file.seek(chunk_size - 16 + chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                break
+            else:
+                # Chunks are padded to an even number of bytes.
+                wave_file.seek(chunk_size + chunk_size % 2, 1)
+
+        data_offset = wave_file.tell()
+
+    if fmt is None or fmt[0] not in [WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE]:
+        raise Exception('"{}" does not contain PCM audio.'.format(file_path))
+
+    format_tag, num_channels, sample_rate, _, _, bits_per_sample = fmt
+    # Some programs write a wrong size for the data chunk of a truncated file.
+    data_size = min(chunk_size, file_size - data_offset)
+
+    if data_size == 0:
+        pcm_data = np.zeros(0, dtype=np.uint8)
+    else:
+        pcm_data = np.memmap(
+            file_path, dtype=np.uint8, mode="r", offset=data_offset, shape=data_size
+        )
+
+    return pcm_data, num_channels, bits_per_sample // 8, sample_rate
+
+
+def pcm_frames(pcm_data, num_channels, bytes_per_sample):
+    """
+    Return a view of raw PCM data as an integer array with a row per frame
+    and a column per channel, without copying it, together with the gain that
+    scales its values to between -1 and 1. Return None if the sample width
+    has no matching integer type.
+    """
+    if bytes_per_sample not in [2, 4]:
+        return None
+
+    data = np.frombuffer(pcm_data, dtype=np.uint8)
+    frame_size = num_channels * bytes_per_sample
+    data = data[: len(data) - len(data) % frame_size]
+    frames = data.view("<i{}".format(bytes_per_sample)).reshape(-1, num_channels)
+    return frames, 1 / 2 ** (8 * bytes_per_sample - 1)
+
+
+def pcm_to_array(pcm_data, num_channels, bytes_per_sample):
+    """
+    Convert raw little-endian PCM data to a float32 NumPy array with a row per
+    frame and a column per channel, with values between -1 and 1.
+    """
+    data = np.frombuffer(pcm_data, dtype=np.uint8)
+
+    if bytes_per_sample == 1:
+        # 8 bit WAV files are unsigned.
+        samples = (data.astype(np.float32) - 128) / 128
+    elif bytes_per_sample == 2:
+        samples = data.view("<i2").astype(np.float32) / 2**15
+    elif bytes_per_sample == 3:
+        # There is no 24 bit integer type, so the three bytes of every sample
+        # are shifted into the top of a 32 bit integer.
+        data = data[: len(data) - len(data) % 3].reshape(-1, 3).astype(np.uint32)
+        shifted = data[:, 0] << 8 | data[:, 1] << 16 | data[:, 2] << 24
+        samples = shifted.view(np.int32).astype(np.float32) / 2**31
+    elif bytes_per_sample == 4:
+        samples = data.view("<i4").astype(np.float32) / 2**31
+    else:
+        raise Exception("Unsupported sample width: {} bytes.".format(bytes_per_sample))
+
+    return samples[: len(samples) - len(samples) % num_channels].reshape(
+        -1, num_channels
+    )
+
+
+def convert_array(samples, sample_rate, target_rate=SAMPLE_RATE, channels=CHANNELS):
+    """
+    Convert an array as returned by pcm_to_array to the given sample rate and
+    number of channels. Mono audio is copied to all channels. Resampling uses
+    linear interpolation.
+    """
+    if samples.shape[1] == 1:
+        samples = np.repeat(samples, channels, axis=1)
+    elif samples.shape[1] != channels:
+        samples = samples[:, :channels]
+
+    if sample_rate != target_rate and len(samples) > 0:
+        n_frames = int(len(samples) * target_rate / sample_rate)
+        positions = np.arange(n_frames) * sample_rate / target_rate
+        frames = np.arange(len(samples))
+        samples = np.column_stack(
+            [
+                np.interp(positions, frames, samples[:, channel])
+                for channel in range(channels)
+            ]
+        )
+
+    return np.ascontiguousarray(samples, dtype=np.float32)
+
+
+def pcm_to_mixing_format(pcm_data, num_channels, bytes_per_sample, sample_rate):
+    """
+    Convert raw PCM data to a float32 array in the mixing format.
+    """
+    samples = pcm_to_array(pcm_data, num_channels, bytes_per_sample)
+    return convert_array(samples, sample_rate)
+
+
+def mix(events, length):
+    """
+    Mix the given events into a buffer of at least the given number of
+    frames. Every event is a tuple of the frame at which it starts, an array
+    with its audio and the gain with which it is mixed. The buffer is
+    extended to fit the last event.
+    """
+    end = max([length] + [start + len(samples) for start, samples, _ in events])
+    buffer = np.zeros((end, CHANNELS), dtype=np.float32)
+
+    for start, samples, gain in events:
+        buffer[start : start + len(samples)] += samples * np.float32(gain)
+
+    return buffer
+
+
+def write_wave_file(file_name, buffer, sample_rate=SAMPLE_RATE):
+    """
+    Write a float buffer as returned by mix to a 16 bit WAV file. Values
+    outside of -1 and 1 are clipped.
+    """
+    pcm = (np.clip(buffer, -1, 1) * (2**15 - 1)).astype("<i2")
+
+    # The file is opened first, so a path that can't be written raises an
+    # OSError without the wave module trying to close a file it never opened.
+    with open(file_name, "wb") as wave_file, wave.open(wave_file, "wb") as output_file:
+        output_file.setnchannels(buffer.shape[1])
+        output_file.setsampwidth(SAMPLE_WIDTH)
+        output_file.setframerate(sample_rate)
+        output_file.writeframes(pcm.tobytes())
+
+
+if __name__ == "__main__":
+    print("Please run from main.py.")
@@ -24,5 +24,12 @@ def rhythm_file_path(meter):
     return "{}_{}.txt".format(meter[0], meter[1])
 
 
+def chain_file_path(meter):
+    """
+    Generate the name of the binary Markov chain file for the given meter.
+    """
+    return "{}_{}.chain".format(meter[0], meter[1])
+
+
 if __name__ == "__main__":
     print("Please run from main.py")
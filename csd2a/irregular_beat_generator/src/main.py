@@ -8,8 +8,12 @@ main.py:
 Given a tempo in BPM, a set of audio files and a set of note durations, play a
 rhythm.
 """
+import asyncio
+import os
+import sys
 import threading
 import time
+import wave
 from sequencer import Sequencer
 from queue import Queue
 from helpers import str_is_int_gt_zero
@@ -54,9 +58,12 @@ class LiveCodingEnvironment:
         help_string = """
         quit - Quits the program
         bpm <tempo> - Sets the tempo to the given tempo in bpm. <tempo> should be a positive integer.
-        regen <track> - Regenerates the rhythm for the given track. <track> should be "high", "mid", "low" or "all".
+        regen <track> - Regenerates the rhythm for the given track. <track> should be the name of a track (eg. "high", "mid" or "low"), "group:<group>" for all tracks in a group (eg. "group:drums") or "all".
         export <filename> - Export the currently playing rhythm to a MIDI file.
         modulate - Modulate the meter from 7/8 to 5/4 or vice versa.
+        keep - Have the Markov chain learn from the rhythm that is currently playing.
+        stats - Print how accurately the sequencer has been timing its notes.
+        render <filename> <bars> - Render the given number of bars of the current rhythm to a WAV file.
         help - Prints this list of commands.
         """
 
@@ -72,11 +79,24 @@ class LiveCodingEnvironment:
             print("Please enter a command.")
             return False
 
-        if command[0] not in ["quit", "bpm", "regen", "export", "modulate", "help"]:
+        if command[0] not in [
+            "quit",
+            "bpm",
+            "regen",
+            "export",
+            "modulate",
+            "keep",
+            "stats",
+            "render",
+            "help",
+        ]:
             print("Please enter a valid command.")
             return False
 
-        if command[0] in ["quit", "modulate", "help"] and len(command) != 1:
+        if (
+            command[0] in ["quit", "modulate", "keep", "stats", "help"]
+            and len(command) != 1
+        ):
             print("This command does not take any parameters.")
             return False
 
@@ -84,11 +104,19 @@ class LiveCodingEnvironment:
             print("Please enter exactly one parameter.")
             return False
 
+        if command[0] == "render" and len(command) != 3:
+            print("Please enter a file name and a number of bars.")
+            return False
+
+        if command[0] == "render" and not str_is_int_gt_zero(command[2]):
+            print("Please enter a valid number of bars.")
+            return False
+
         if command[0] == "bpm" and not str_is_int_gt_zero(command[1]):
             print("Please enter a valid BPM.")
             return False
 
-        if command[0] == "regen" and command[1] not in ["high", "mid", "low", "all"]:
+        if command[0] == "regen" and len(self.sequencer.get_tracks(command[1])) == 0:
             print("Please enter a valid track to regenerate.")
             return False
 
@@ -111,11 +139,37 @@ class LiveCodingEnvironment:
             self.handle_command((command[0], command[1]))
         elif command[0] == "modulate":
             self.handle_command_with_wait((command[0],))
+        elif command[0] == "keep":
+            self.handle_command((command[0],))
+        elif command[0] == "stats":
+            print(self.sequencer.timing)
+        elif command[0] == "render":
+            self.render(command[1], int(command[2]))
         elif command[0] == "help":
             self.print_help()
 
         return False
 
+    def render(self, file_name, bars):
+        """
+        Have the sequencer make a copy of itself and render the given number
+        of bars of that copy to a WAV file in this thread, so playback isn't
+        interrupted.
+        """
+        self.queue_outgoing.put(("render",))
+        self.render_copy(self.queue_incoming.get(), file_name, bars)
+
+    def render_copy(self, renderer, file_name, bars):
+        """
+        Render the given number of bars of a copy of the sequencer to a WAV
+        file. If the file can't be written, tell the user instead of stopping
+        the input loop.
+        """
+        try:
+            renderer.render(file_name, bars)
+        except (OSError, wave.Error) as error:
+            print('Could not render to "{}": {}'.format(file_name, error))
+
     def get_user_input(self):
         """
         Get input until the user indicates they want to quit.
@@ -141,11 +195,136 @@ class LiveCodingEnvironment:
             play_thread.start()
             self.get_user_input()
         except KeyboardInterrupt:
-            self.queue_outgoing.put("quit")
+            self.queue_outgoing.put(("quit",))
 
         play_thread.join()
         print("Bye!")
 
 
+class AsyncLiveCodingEnvironment(LiveCodingEnvironment):
+    """
+    Handles user input like LiveCodingEnvironment, but runs the sequencer as
+    a coroutine in an asyncio event loop instead of in a separate thread.
+    """
+
+    def __init__(self):
+        """
+        Initialize the live coding environment with asyncio queues.
+        """
+        self.queue_outgoing = asyncio.Queue()
+        self.queue_incoming = asyncio.Queue()
+        self.sequencer = Sequencer(self.queue_outgoing, self.queue_incoming)
+        self.waiting_for_sequencer = False
+        self.render_request = None
+
+    def handle_command_with_wait(self, command):
+        """
+        Send a command to the sequencer. The input loop waits until the
+        sequencer is done before asking for the next command.
+        """
+        self.queue_outgoing.put_nowait(command)
+        self.waiting_for_sequencer = True
+
+    def handle_command(self, command):
+        """
+        Send a command to the sequencer.
+        """
+        self.queue_outgoing.put_nowait(command)
+
+    def render(self, file_name, bars):
+        """
+        Ask the sequencer for a copy of itself to render. The input loop
+        renders it in an executor when it arrives.
+        """
+        self.queue_outgoing.put_nowait(("render",))
+        self.waiting_for_sequencer = True
+        self.render_request = (file_name, bars)
+
+    def read_lines(self, loop, lines):
+        """
+        Read lines from standard input and put them on the given asyncio queue
+        of the given event loop, followed by None at the end of the input.
+        This runs in a daemon thread, so an interrupted program exits without
+        waiting for the user to press enter, as it would if input was read in
+        the loop's default executor. The lines are read from the file
+        descriptor, as a daemon thread waiting in input holds a lock that
+        Python needs when it exits.
+        """
+        buffer = b""
+
+        try:
+            while True:
+                data = os.read(sys.stdin.fileno(), 1024)
+
+                if not data:
+                    loop.call_soon_threadsafe(lines.put_nowait, None)
+                    return
+
+                *complete_lines, buffer = (buffer + data).split(b"\n")
+
+                for line in complete_lines:
+                    loop.call_soon_threadsafe(
+                        lines.put_nowait, line.decode().rstrip("\r")
+                    )
+        except RuntimeError:
+            # The event loop was closed while waiting for input.
+            return
+
+    async def get_user_input(self):
+        """
+        Get input until the user indicates they want to quit. Input is read
+        in a separate thread (see read_lines), so the event loop keeps running
+        while waiting for the user. The end of the input quits.
+        """
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        threading.Thread(
+            target=self.read_lines, args=(loop, lines), daemon=True
+        ).start()
+        done = False
+
+        while not done:
+            print(self.sequencer)
+            print(">", end="", flush=True)
+            user_input = await lines.get()
+
+            if user_input is None:
+                user_input = "quit"
+
+            if self.input_valid(user_input):
+                done = self.handle_user_input(user_input)
+
+            if self.waiting_for_sequencer:
+                reply = await self.queue_incoming.get()
+                self.waiting_for_sequencer = False
+
+            # Render in an executor, so the sequencer keeps playing.
+            if self.render_request is not None:
+                await loop.run_in_executor(
+                    None, self.render_copy, reply, *self.render_request
+                )
+                self.render_request = None
+
+    async def run(self):
+        """
+        Run the user input loop and the sequencer in the same event loop.
+        """
+        await asyncio.gather(self.sequencer.start_async(), self.get_user_input())
+
+    def start(self):
+        """
+        Start the event loop.
+        """
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+
+        print("Bye!")
+
+
 if __name__ == "__main__":
-    LiveCodingEnvironment().start()
+    if "--asyncio" in sys.argv:
+        AsyncLiveCodingEnvironment().start()
+    else:
+        LiveCodingEnvironment().start()
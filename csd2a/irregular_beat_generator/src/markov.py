@@ -8,8 +8,20 @@ markov.py:
 Contains the necessary classes to generate a polyphonic rhythm using a Markov
 chain.
 """
+import json
+import numpy as np
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from math import ceil
+from os import cpu_count, listdir
+from os.path import getmtime, isdir, isfile, join
 from random import random
 
+CHAIN_FILE_MAGIC = b"MKCHAIN1"
+CHAIN_FILE_EXTENSION = ".chain"
+
 
 class Node:
     def __init__(self, name):
@@ -19,6 +31,7 @@ class Node:
         """
         self.name = name
         self.edges = []
+        self.total_value = 0
 
     def __str__(self):
         return "Node {}.".format(self.name)
@@ -27,12 +40,12 @@ class Node:
         """
         Add an edge from this node to the given node.
         """
-        total_value = sum(edge.value for edge in self.edges)
-
-        if total_value + value > 1:
+        # Allow for rounding errors in values that add up to exactly 1.
+        if self.total_value + value > 1 + 1e-9:
             raise Exception("Node: Value of edges exceeded 1")
 
         self.edges.append(Edge(self, node, value))
+        self.total_value += value
 
     def follow_random_edge(self):
         """
@@ -72,6 +85,496 @@ class Edge:
         return self.node_to
 
 
+class CompiledMarkovChain:
+    """
+    A compiled Markov chain identifies its states by integer ids instead of
+    Node objects. For every state, the ids of the states that can follow it are
+    stored next to its cumulative transition probabilities, so a random
+    transition is chosen with a binary search instead of by walking a list of
+    edges.
+
+    The rows of all states are stored back to back in flat NumPy arrays:
+    the row of state i is found between offsets[i] and offsets[i + 1] in
+    flat_targets and flat_cumulative. Rows are sampled from as lists, which
+    are faster to search than slices of NumPy arrays, so every row is
+    converted to lists and kept in rows the first time it is used. Rows that
+    are changed by learning, and the rows of states added by learning, are
+    only kept as lists, until compact merges them into the flat arrays.
+    """
+
+    def __init__(self, names, targets, weights, symbols=None):
+        """
+        Initialize the compiled chain given the state names, and for each
+        state the ids of the states it leads to and the (unnormalized) weights
+        of those transitions. Symbols are the onsets played in each state. By
+        default they are the state names, which is the case for first order
+        chains.
+        """
+        self.names = list(names)
+        self.symbols = list(names if symbols is None else symbols)
+        self.index = {name: i for i, name in enumerate(names)}
+        self.order = len(names[0]) if names and isinstance(names[0], tuple) else 1
+        self.rows = {}  # Lists of targets and cumulative probabilities by state.
+        self.pending = {}
+        self.state = None
+        self.sparse = None
+        self.constraint_cache = {}
+        self.set_rows(targets, weights)
+
+    def __str__(self):
+        return "Compiled Markov chain with {} states.".format(len(self.names))
+
+    def copy(self):
+        """
+        Return a copy of this chain that can be sampled from and can learn
+        without affecting this chain. The flat arrays and the cached tables
+        are shared, as they are replaced rather than changed.
+        """
+        chain = copy(self)
+        chain.names = self.names[:]
+        chain.symbols = self.symbols[:]
+        chain.index = dict(self.index)
+        chain.rows = dict(self.rows)
+        chain.totals = self.totals[:]
+        chain.pending = {state: dict(counts) for state, counts in self.pending.items()}
+        chain.constraint_cache = dict(self.constraint_cache)
+        return chain
+
+    def cumulative_row(self, weights):
+        """
+        Turn a list of transition weights into a list of cumulative
+        probabilities. The last value is exactly 1, so every random number in
+        [0, 1) selects a transition.
+        """
+        total = sum(weights)
+        cumulative = []
+        running_total = 0
+
+        for weight in weights:
+            running_total += weight
+            cumulative.append(running_total / total)
+
+        cumulative[-1] = 1.0
+        return cumulative
+
+    def set_rows(self, targets, weights):
+        """
+        Fill the flat arrays given, for every state, a list of the states it
+        leads to and a list of the (unnormalized) weights of those
+        transitions.
+        """
+        lengths = np.array([len(row_targets) for row_targets in targets], np.int64)
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(lengths)
+        n_transitions = int(self.offsets[-1])
+        self.flat_targets = np.fromiter(
+            (target for row in targets for target in row),
+            dtype=np.int64,
+            count=n_transitions,
+        )
+        flat_weights = np.fromiter(
+            (weight for row in weights for weight in row),
+            dtype=np.float64,
+            count=n_transitions,
+        )
+        row_ids = np.repeat(np.arange(len(lengths)), lengths)
+        totals = np.bincount(row_ids, flat_weights, minlength=len(lengths))
+        # Normalize the rows before adding them up, so the cumulative
+        # probabilities of every row are accurate however many rows there are.
+        probabilities = flat_weights / totals[row_ids]
+        before = np.zeros(n_transitions + 1)
+        before[1:] = np.cumsum(probabilities)
+        self.flat_cumulative = before[1:] - before[self.offsets[:-1]][row_ids]
+        self.flat_cumulative[self.offsets[1:][lengths > 0] - 1] = 1.0
+        self.totals = totals.tolist()
+
+    def get_row(self, state):
+        """
+        Return the targets and the cumulative probabilities of the given
+        state's transitions as lists.
+        """
+        row = self.rows.get(state)
+
+        if row is None:
+            start, end = self.offsets[state], self.offsets[state + 1]
+            row = (
+                self.flat_targets[start:end].tolist(),
+                self.flat_cumulative[start:end].tolist(),
+            )
+            self.rows[state] = row
+
+        return row
+
+    def compact(self):
+        """
+        Merge the rows kept as lists into the flat arrays.
+        """
+        if not self.rows:
+            return
+
+        old_lengths = np.diff(self.offsets)
+        lengths = np.zeros(len(self.names), dtype=np.int64)
+        lengths[: len(old_lengths)] = old_lengths
+
+        for state, (row_targets, _) in self.rows.items():
+            lengths[state] = len(row_targets)
+
+        offsets = np.zeros(len(self.names) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        targets = np.empty(offsets[-1], dtype=np.int64)
+        cumulative = np.empty(offsets[-1])
+
+        # Copy the rows that didn't change to their new positions at once.
+        changed = np.zeros(len(old_lengths), dtype=bool)
+        changed[[state for state in self.rows if state < len(old_lengths)]] = True
+        row_ids = np.repeat(np.arange(len(old_lengths)), old_lengths)
+        keep = ~changed[row_ids]
+        positions = (
+            offsets[:-1][row_ids] + np.arange(len(row_ids)) - self.offsets[row_ids]
+        )
+        targets[positions[keep]] = self.flat_targets[keep]
+        cumulative[positions[keep]] = self.flat_cumulative[keep]
+
+        for state, (row_targets, row_cumulative) in self.rows.items():
+            targets[offsets[state] : offsets[state + 1]] = row_targets
+            cumulative[offsets[state] : offsets[state + 1]] = row_cumulative
+
+        self.offsets = offsets
+        self.flat_targets = targets
+        self.flat_cumulative = cumulative
+        self.rows = {}
+
+    def add_state(self, name, symbol):
+        """
+        Add a state without transitions and return its id.
+        """
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.symbols.append(symbol)
+        self.rows[self.index[name]] = ([], [])
+        self.totals.append(0)
+        return self.index[name]
+
+    def learn(self, onsets):
+        """
+        Add the transitions in the given list of onsets, processed as if the
+        rhythm is looping, to the chain's counts. Onsets and contexts the
+        chain has not seen before become new states. The affected rows are
+        only renormalized the next time the chain is used.
+        """
+        length = len(onsets)
+
+        for i in range(1, length + 1):
+            if self.order == 1:
+                name = onsets[i - 1]
+                next_name = onsets[i % length]
+            else:
+                name = tuple(onsets[j % length] for j in range(i - self.order, i))
+                next_name = name[1:] + (onsets[i % length],)
+
+            for state_name in [name, next_name]:
+                if state_name not in self.index:
+                    symbol = state_name if self.order == 1 else state_name[-1]
+                    self.add_state(state_name, symbol)
+
+            state = self.index[name]
+            target = self.index[next_name]
+            counts = self.pending.setdefault(state, {})
+            counts[target] = counts.get(target, 0) + 1
+
+    def update_rows(self):
+        """
+        Add the counts collected by learn to the rows they belong to and
+        renormalize those rows. Tables derived from the transition
+        probabilities are rebuilt when they are needed again.
+        """
+        for state, counts in self.pending.items():
+            weights = {}
+            previous = 0
+
+            for target, cumulative in zip(*self.get_row(state)):
+                weights[target] = (cumulative - previous) * self.totals[state]
+                previous = cumulative
+
+            for target, count in counts.items():
+                weights[target] = weights.get(target, 0) + count
+
+            self.rows[state] = (
+                list(weights.keys()),
+                self.cumulative_row(list(weights.values())),
+            )
+            self.totals[state] = sum(weights.values())
+
+        self.pending = {}
+        self.sparse = None
+        self.constraint_cache = {}
+
+    def save(self, file_path):
+        """
+        Write the chain's transition table to a binary file. The file starts
+        with a JSON header holding the state names and symbols, followed by
+        four flat arrays: the offset of every state's row, the targets of all
+        rows, the cumulative probabilities of all rows and the total weight
+        (number of transitions counted) of every row.
+        """
+        if self.pending:
+            self.update_rows()
+
+        self.compact()
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        targets = np.asarray(self.flat_targets, dtype=np.int64)
+        cumulative = np.asarray(self.flat_cumulative, dtype=np.float64)
+
+        # JSON has no tuples, so the names of higher order states are stored
+        # as lists.
+        header = json.dumps(
+            {
+                "names": [
+                    list(name) if isinstance(name, tuple) else name
+                    for name in self.names
+                ],
+                "symbols": self.symbols,
+                "n_transitions": len(targets),
+            }
+        ).encode()
+        # Pad the header so the arrays are aligned to 8 bytes.
+        header += b" " * (-len(header) % 8)
+
+        with open(file_path, "wb") as output_file:
+            output_file.write(CHAIN_FILE_MAGIC)
+            output_file.write(np.uint64(len(header)).tobytes())
+            output_file.write(header)
+            output_file.write(offsets.tobytes())
+            output_file.write(targets.tobytes())
+            output_file.write(cumulative.tobytes())
+            output_file.write(np.array(self.totals, dtype=np.float64).tobytes())
+
+    @classmethod
+    def load(cls, file_path, memory_map=False):
+        """
+        Load a chain written by save. The flat arrays of the chain are views
+        of the file's contents. If memory_map is True, the file is
+        memory-mapped instead of read, so only the parts of the file that are
+        used are loaded into memory.
+        """
+        with open(file_path, "rb") as input_file:
+            if input_file.read(len(CHAIN_FILE_MAGIC)) != CHAIN_FILE_MAGIC:
+                raise Exception("{} is not a Markov chain file.".format(file_path))
+
+            header_length = int(np.frombuffer(input_file.read(8), np.uint64)[0])
+            header = json.loads(input_file.read(header_length))
+
+        names = [
+            tuple(name) if isinstance(name, list) else name for name in header["names"]
+        ]
+        n_transitions = header["n_transitions"]
+        start = len(CHAIN_FILE_MAGIC) + 8 + header_length
+
+        if memory_map:
+            # A plain array view of the map is faster to slice than a memmap.
+            data = np.memmap(file_path, dtype=np.uint8, mode="r").view(np.ndarray)
+        else:
+            data = np.fromfile(file_path, dtype=np.uint8)
+
+        chain = cls(names, [], [], header["symbols"])
+        chain.offsets = data[start : start + 8 * (len(names) + 1)].view(np.int64)
+        start += 8 * (len(names) + 1)
+        chain.flat_targets = data[start : start + 8 * n_transitions].view(np.int64)
+        start += 8 * n_transitions
+        chain.flat_cumulative = data[start : start + 8 * n_transitions].view(np.float64)
+        start += 8 * n_transitions
+        chain.totals = data[start : start + 8 * len(names)].view(np.float64).tolist()
+
+        return chain
+
+    def sparse_rows(self):
+        """
+        Return the transitions of all states as flat NumPy arrays: the row
+        offsets, the target of every transition, its probability and the id
+        of the state it starts from. The arrays are only built the first time
+        they are needed.
+        """
+        if self.pending:
+            self.update_rows()
+
+        if self.sparse is None:
+            self.compact()
+            lengths = np.diff(self.offsets)
+            row_ids = np.repeat(np.arange(len(lengths)), lengths)
+            probabilities = np.diff(self.flat_cumulative, prepend=0)
+            # The first probability of every row is its first cumulative one.
+            starts = self.offsets[:-1][lengths > 0]
+            probabilities[starts] = self.flat_cumulative[starts]
+            self.sparse = (self.offsets, self.flat_targets, probabilities, row_ids)
+
+        return self.sparse
+
+    def constrained_tables(self, length, constraints):
+        """
+        Return the tables used to sample sequences of the given length that
+        meet the constraints (a dictionary mapping positions to required
+        onsets). They are cached per length and set of constraints, so they
+        are only computed once. There are three tables, each with an entry per
+        position in the sequence:
+
+        - reachable: for every state, the probability that the constraints
+          after that position can be met if the chain is in that state at that
+          position. These are the backward messages used to condition the
+          transitions on the constraints.
+        - weights: the transition probabilities into that position
+          conditioned on the constraints, added up over all rows in one flat
+          array that starts with a 0. The conditioned cumulative weights of
+          state i's row are weights[offsets[i]:offsets[i + 1] + 1] minus
+          their first value.
+        - rows: a dictionary with the conditioned rows of the states that
+          have been visited at that position, as lists of targets and
+          cumulative probabilities (see conditioned_row).
+        """
+        constraints = {
+            position: name
+            for position, name in constraints.items()
+            if position < length
+        }
+        key = (length, tuple(sorted(constraints.items())))
+        _, targets, probabilities, row_ids = self.sparse_rows()
+
+        if key not in self.constraint_cache:
+            n_states = len(self.names)
+            allowed = np.ones((length, n_states))
+            symbols = np.array(self.symbols, dtype=object)
+
+            for position, symbol in constraints.items():
+                allowed[position] = symbols == symbol
+
+                if not allowed[position].any():
+                    raise Exception("Node with name {} does not exist.".format(symbol))
+
+            reachable = np.empty((length, n_states))
+            reachable[-1] = allowed[-1]
+
+            for i in range(length - 2, -1, -1):
+                reachable[i] = allowed[i] * np.bincount(
+                    row_ids,
+                    probabilities * reachable[i + 1][targets],
+                    minlength=n_states,
+                )
+
+            if reachable[0, 0] == 0:
+                raise Exception("The constraints can not be met by this chain.")
+
+            weights = np.zeros((length, len(targets) + 1))
+
+            for i in range(1, length):
+                np.cumsum(probabilities * reachable[i][targets], out=weights[i, 1:])
+
+            rows = [{} for _ in range(length)]
+            self.constraint_cache[key] = (reachable, weights, rows)
+
+        return self.constraint_cache[key]
+
+    def conditioned_row(self, weights, state):
+        """
+        Return the targets of the given state and the cumulative
+        probabilities of moving to them, given the conditioned weights of one
+        position (see constrained_tables), as lists.
+        """
+        offsets, targets = self.sparse_rows()[:2]
+        start, end = offsets[state], offsets[state + 1]
+        row_weights = weights[start : end + 1]
+        cumulative = (row_weights[1:] - row_weights[0]) / (
+            row_weights[-1] - row_weights[0]
+        )
+        # Round the last cumulative probability up to 1, including those of the
+        # transitions after the last possible one, so they are never chosen.
+        cumulative[cumulative == cumulative[-1]] = 1.0
+        return targets[start:end].tolist(), cumulative.tolist()
+
+    def sample_constrained(self, length, constraints):
+        """
+        Generate a single sequence of state ids of the given length that
+        starts in the first state and meets the given constraints, in one
+        forward pass. The conditioned rows are converted to lists the first
+        time a state is visited at a position, so after that every step is a
+        binary search, just like an unconstrained step.
+        """
+        _, weights, rows = self.constrained_tables(length, constraints)
+        state = 0
+        states = [state]
+
+        for i in range(1, length):
+            row = rows[i].get(state)
+
+            if row is None:
+                row = rows[i][state] = self.conditioned_row(weights[i], state)
+
+            state = row[0][bisect_right(row[1], random())]
+            states.append(state)
+
+        self.state = state
+        return states
+
+    def sample_batch(self, n, length, constraints=None, rng=None):
+        """
+        Generate n sequences of the given length at once. Return a NumPy array
+        of shape (n, length) containing state ids. Every sequence starts in the
+        first state and meets the given constraints.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        weights = self.constrained_tables(length, constraints or {})[1]
+        offsets, targets = self.sparse_rows()[:2]
+        states = np.zeros((n, length), dtype=np.intp)
+        random_values = rng.random((n, length))
+
+        for i in range(1, length):
+            # The conditioned weights of all rows are added up in one array,
+            # so the next state of every sequence is found with a single
+            # search within the part of the array that holds its row.
+            starts = offsets[states[:, i - 1]]
+            ends = offsets[states[:, i - 1] + 1]
+            values = weights[i, starts] + random_values[:, i] * (
+                weights[i, ends] - weights[i, starts]
+            )
+            choices = np.searchsorted(weights[i], values, side="right") - 1
+            states[:, i] = targets[np.clip(choices, starts, ends - 1)]
+
+        return states
+
+    def set_state(self, name):
+        """
+        Set the current state to the state with the given name.
+        """
+        if name not in self.index:
+            raise Exception("Node with name {} does not exist.".format(name))
+
+        self.state = self.index[name]
+
+    def sample(self, state):
+        """
+        Return the id of a random state following the given state.
+        """
+        if self.pending:
+            self.update_rows()
+
+        row = self.rows.get(state)
+
+        if row is None:
+            row = self.get_row(state)
+
+        return row[0][bisect_right(row[1], random())]
+
+    def step(self):
+        """
+        Change the chain's state. A chain without a state starts in its first
+        state.
+        """
+        if self.state is None:
+            self.state = 0
+        else:
+            self.state = self.sample(self.state)
+
+
 class MarkovChain:
     """
     A markov chain consists of a set of nodes. The nodes are connected by
@@ -79,12 +582,19 @@ class MarkovChain:
     from one node to another at every timestep.
     """
 
-    def __init__(self):
+    def __init__(self, order=1):
         """
         Markov chains are initialized stateless and with an empty set of nodes.
+        The order is the number of previous onsets the next onset depends on.
+        In a first order chain, nodes are named for a single onset. In a chain
+        of a higher order, nodes are named for a tuple of the last onsets, and
+        only the contexts that occur in the rhythm become nodes.
         """
         self.nodes = []
+        self.node_indices = {}
         self.state = None
+        self.order = order
+        self.transition_counts = {}
 
     def add_node(self, name):
         """
@@ -93,6 +603,7 @@ class MarkovChain:
         if self.node_exists(name):
             raise Exception("A node with name {} already exists.".format(name))
 
+        self.node_indices[name] = len(self.nodes)
         self.nodes.append(Node(name))
 
     def add_edge_by_node_index(self, node_1, node_2, value):
@@ -113,7 +624,8 @@ class MarkovChain:
         """
         Get a node by its name.
         """
-        return next((node for node in self.nodes if node.name == node_name), None)
+        index = self.node_indices.get(node_name)
+        return None if index is None else self.nodes[index]
 
     def add_edge_by_node_name(self, node_1_name, node_2_name, value):
         """
@@ -138,7 +650,7 @@ class MarkovChain:
         Return true if a node with the given name exists. Return false
         otherwise.
         """
-        return any(node.name == node_name for node in self.nodes)
+        return node_name in self.node_indices
 
     def set_state(self, node_name):
         """
@@ -157,70 +669,364 @@ class MarkovChain:
         else:
             self.state = self.state.follow_random_edge()
 
-    def from_rhythm_file(self, file_path):
+    def save(self, file_path):
         """
-        Read a rhythm from a file and generate a markov chain.
+        Write the compiled version of this chain to a binary file. Load it
+        with CompiledMarkovChain.load.
+        """
+        self.compile().save(file_path)
+
+    def compile(self):
+        """
+        Return a CompiledMarkovChain with the same states and transitions as
+        this chain. Edges with a value of 0 are left out. If a node's edges
+        don't add up to 1, the remaining probability is used to stay in that
+        node, just like Node.follow_random_edge does.
+        """
+        node_ids = {node: i for i, node in enumerate(self.nodes)}
+        targets = []
+        weights = []
+
+        for i, node in enumerate(self.nodes):
+            row_targets = []
+            row_weights = []
+
+            for edge in node.edges:
+                if edge.value > 0:
+                    row_targets.append(node_ids[edge.node_to])
+                    row_weights.append(edge.value)
+
+            remainder = 1 - sum(row_weights)
+
+            if remainder > 1e-9:
+                row_targets.append(i)
+                row_weights.append(remainder)
 
-        NOTE This function is very messy, but I decided to prioritize
-             implementing more functionality over cleaning this up. The
-             comments should help understand what is happening.
+            # Weigh the row by the number of transitions it was built from, so
+            # transitions learned later have the right influence.
+            total = sum(self.transition_counts.get(node.name, {}).values()) or 1
+            row_weights = [weight * total for weight in row_weights]
+
+            targets.append(row_targets)
+            weights.append(row_weights)
+
+        names = [node.name for node in self.nodes]
+        symbols = names if self.order == 1 else [name[-1] for name in names]
+        return CompiledMarkovChain(names, targets, weights, symbols)
+
+    def next_state_name(self, state_name, onset):
+        """
+        Return the name of the state the chain is in after the given onset
+        follows the given state. In a first order chain this is the onset
+        itself. In a higher order chain it is the context formed by the last
+        onsets of the given state followed by the new onset.
         """
+        if self.order == 1:
+            return onset
 
+        return state_name[1:] + (onset,)
+
+    def from_transition_counts(self, transition_counts):
+        """
+        Generate a markov chain from a dictionary that maps every state name
+        to a dictionary of the onsets following it and the number of times
+        they do. Only states that are followed by something become nodes.
+        """
         self.nodes = []
+        self.node_indices = {}
         self.state = None
+        self.transition_counts = transition_counts
 
-        with open(file_path) as input_file:
-            lines = [line for line in input_file]
+        # Add all nodes to the Markov Chain.
+        for node_name in transition_counts:
+            self.add_node(node_name)
 
-        lines.append(lines[-1])  # Process the rhythm as if it is looping
-        rhythm = {}
-        total_length = 0
+        # Add the edges with their associated weights to the Markov Chain.
+        for from_node_name, counts in transition_counts.items():
+            from_node = self.get_node_by_name(from_node_name)
+            total = sum(counts.values())
+
+            for onset, count in counts.items():
+                to_node_name = self.next_state_name(from_node_name, onset)
+                to_node = self.get_node_by_name(to_node_name)
+
+                if to_node is not None:
+                    from_node.add_edge(to_node, count / total)
+
+    def from_rhythm_file(self, file_path):
+        """
+        Read a rhythm from a file and generate a markov chain.
+        """
+        trainer = MarkovTrainer(self.order)
+        trainer.add_rhythm_file(file_path)
+        self.from_transition_counts(trainer.transition_counts)
+
+
+class MarkovTrainer:
+    """
+    A Markov trainer counts the transitions in any number of rhythms. Rhythm
+    files are read line by line, so only a single rhythm is kept in memory at
+    a time. Count tables of different trainers, for example trainers that ran
+    in separate processes, can be merged. Once all rhythms have been counted,
+    the trainer generates a Markov chain.
+    """
+
+    def __init__(self, order=1):
+        """
+        Initialize the trainer for Markov chains of the given order with an
+        empty count table. The table maps every state name to a dictionary of
+        the onsets following it and the number of times they do.
+        """
+        self.order = order
+        self.transition_counts = {}
+
+    def add_onsets(self, onsets):
+        """
+        Count the transitions in the given list of onsets. The rhythm is
+        processed as if it is looping, so the last onsets are followed by the
+        first and every state has a successor.
+        """
+        length = len(onsets)
+
+        for i in range(1, length + 1):
+            if self.order == 1:
+                state_name = onsets[i - 1]
+            else:
+                state_name = tuple(onsets[j % length] for j in range(i - self.order, i))
 
-        for line in lines:
-            # Get part name and rhythm from line.
-            name, part = line.split()
-            rhythm[name] = [*part]
+            counts = self.transition_counts.setdefault(state_name, {})
+            onset = onsets[i % length]
+            counts[onset] = counts.get(onset, 0) + 1
 
-            # Track the total length of the rhythm in 16th notes.
-            if len(rhythm[name]) > total_length:
-                total_length = len(rhythm[name])
+    def add_rhythm(self, rhythm):
+        """
+        Count the transitions in a rhythm given as a dictionary mapping part
+        names to strings in which an x marks a note and any other character a
+        rest.
+        """
+        if len(rhythm) == 0:
+            return
 
+        total_length = max(len(part) for part in rhythm.values())
         onsets = []
 
         for i in range(total_length):
-            node_name = ""
+            onset = ""
 
-            # Nodes are named for their events (eg. low for a kick, high&low for a
-            # kick and a hihat simultaneously, empty string for a rest)
-            for key in rhythm.keys():
-                if rhythm[key][i] == "x":
-                    node_name = key if node_name == "" else node_name + "&" + key
+            # Onsets are named for their events (eg. low for a kick, high&low
+            # for a kick and a hihat simultaneously, empty string for a rest)
+            for name, part in rhythm.items():
+                if i < len(part) and part[i] == "x":
+                    onset = name if onset == "" else onset + "&" + name
 
-            onsets.append(node_name)
+            onsets.append(onset)
 
-        edges = {}
-        onset = onsets.pop(0)
+        self.add_onsets(onsets)
 
-        # Create a dictionary of the ways in which nodes follow each other.
-        while len(onsets) != 0:
-            if onset in edges.keys():
-                edges[onset].append(onsets[0])
-            else:
-                edges[onset] = [onsets[0]]
+    def add_rhythm_file(self, file_path):
+        """
+        Count the transitions in a rhythm file. Every line holds a part name
+        and its rhythm. A file can contain multiple rhythms separated by empty
+        lines.
+        """
+        rhythm = {}
 
-            onset = onsets.pop(0)
+        with open(file_path) as input_file:
+            for line in input_file:
+                if line.strip() == "":
+                    self.add_rhythm(rhythm)
+                    rhythm = {}
+                    continue
 
-        # Add all nodes to the Markov Chain.
-        for node_name in edges.keys():
-            self.add_node(node_name)
+                # Get part name and rhythm from line.
+                name, part = line.split()
+                rhythm[name] = part
 
-        # Add the edges with their associated weights to the Markov Chain.
-        for from_node_name in edges.keys():
-            for to_node_name in edges.keys():
-                percent = edges[from_node_name].count(to_node_name) / len(
-                    edges[from_node_name]
+        self.add_rhythm(rhythm)
+
+    def add_directory(self, directory_path, extension=".txt"):
+        """
+        Count the transitions in all rhythm files with the given extension in
+        the given directory.
+        """
+        for file_path in rhythm_file_paths([directory_path], extension):
+            self.add_rhythm_file(file_path)
+
+    def add_paths(self, paths):
+        """
+        Count the transitions in all given rhythm files and directories.
+        """
+        for file_path in rhythm_file_paths(paths):
+            self.add_rhythm_file(file_path)
+
+    def add_paths_parallel(self, paths, max_workers=None, chunks_per_worker=4):
+        """
+        Count the transitions in all given rhythm files and directories using
+        a pool of processes. The files are divided into chunks, every worker
+        counts the transitions in its chunk, and the resulting count tables
+        are merged into this trainer's counts in the order of the files.
+        """
+        file_paths = list(rhythm_file_paths(paths))
+
+        if len(file_paths) == 0:
+            return
+
+        if max_workers is None:
+            max_workers = cpu_count() or 1
+
+        n_chunks = min(len(file_paths), max_workers * chunks_per_worker)
+        chunk_size = ceil(len(file_paths) / n_chunks)
+        chunks = [
+            file_paths[i : i + chunk_size]
+            for i in range(0, len(file_paths), chunk_size)
+        ]
+
+        with ProcessPoolExecutor(max_workers) as executor:
+            for transition_counts in executor.map(
+                count_rhythm_files, chunks, [self.order] * len(chunks)
+            ):
+                self.merge(transition_counts)
+
+    def merge(self, transition_counts):
+        """
+        Add the counts of another count table to this trainer's counts.
+        """
+        for state_name, counts in transition_counts.items():
+            own_counts = self.transition_counts.setdefault(state_name, {})
+
+            for onset, count in counts.items():
+                own_counts[onset] = own_counts.get(onset, 0) + count
+
+    def save_counts(self, file_path):
+        """
+        Write the count table to a JSON file, so it can be merged by a trainer
+        in another process.
+        """
+        table = [
+            [state_name, counts]
+            for state_name, counts in self.transition_counts.items()
+        ]
+
+        with open(file_path, "w") as output_file:
+            json.dump({"order": self.order, "counts": table}, output_file)
+
+    def merge_counts_file(self, file_path):
+        """
+        Merge a count table written by save_counts into this trainer's counts.
+        """
+        with open(file_path) as input_file:
+            data = json.load(input_file)
+
+        if data["order"] != self.order:
+            raise Exception(
+                "Can not merge counts of order {} into a trainer of order {}.".format(
+                    data["order"], self.order
                 )
-                self.add_edge_by_node_name(from_node_name, to_node_name, percent)
+            )
+
+        # JSON has no tuples, so the contexts of higher order chains are
+        # stored as lists.
+        self.merge(
+            {
+                state_name if self.order == 1 else tuple(state_name): counts
+                for state_name, counts in data["counts"]
+            }
+        )
+
+    def to_markov_chain(self):
+        """
+        Generate a Markov chain from the transitions counted so far.
+        """
+        markov_chain = MarkovChain(self.order)
+        markov_chain.from_transition_counts(self.transition_counts)
+        return markov_chain
+
+
+class ChainCache:
+    """
+    A chain cache keeps the compiled Markov chains of recently used rhythm
+    files in memory. Chains are identified by the path and modification time
+    of their rhythm file, so a chain is rebuilt when its file changes. When
+    the cache is full, the least recently used chain is removed.
+    """
+
+    def __init__(self, order=1, max_size=8):
+        """
+        Initialize an empty cache for chains of the given order.
+        """
+        self.order = order
+        self.max_size = max_size
+        self.chains = OrderedDict()
+
+    def get(self, file_path):
+        """
+        Return the compiled Markov chain for the given rhythm file or chain
+        file (see CompiledMarkovChain.save). Build or load it if it is not in
+        the cache yet.
+        """
+        key = (file_path, getmtime(file_path))
+
+        if key in self.chains:
+            self.chains.move_to_end(key)
+            return self.chains[key]
+
+        # Remove chains built from an older version of the file.
+        for old_key in [old_key for old_key in self.chains if old_key[0] == file_path]:
+            del self.chains[old_key]
+
+        if file_path.endswith(CHAIN_FILE_EXTENSION):
+            self.chains[key] = CompiledMarkovChain.load(file_path)
+        else:
+            markov_chain = MarkovChain(self.order)
+            markov_chain.from_rhythm_file(file_path)
+            self.chains[key] = markov_chain.compile()
+
+        while len(self.chains) > self.max_size:
+            self.chains.popitem(last=False)
+
+        return self.chains[key]
+
+    def copy(self):
+        """
+        Return a cache holding copies of the chains in this cache (see
+        CompiledMarkovChain.copy).
+        """
+        cache = copy(self)
+        cache.chains = OrderedDict(
+            (key, chain.copy()) for key, chain in self.chains.items()
+        )
+        return cache
+
+
+def rhythm_file_paths(paths, extension=".txt"):
+    """
+    Yield the paths of all given files, and of all files with the given
+    extension in the given directories.
+    """
+    for path in paths:
+        if not isdir(path):
+            yield path
+            continue
+
+        for file_name in sorted(listdir(path)):
+            file_path = join(path, file_name)
+
+            if isfile(file_path) and file_name.endswith(extension):
+                yield file_path
+
+
+def count_rhythm_files(file_paths, order):
+    """
+    Count the transitions in the given rhythm files and return the count
+    table. This function is run by the worker processes of
+    MarkovTrainer.add_paths_parallel.
+    """
+    trainer = MarkovTrainer(order)
+
+    for file_path in file_paths:
+        trainer.add_rhythm_file(file_path)
+
+    return trainer.transition_counts
 
 
 if __name__ == "__main__":
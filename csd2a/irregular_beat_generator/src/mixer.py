@@ -0,0 +1,212 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+mixer.py:
+Contains a mixer that plays all notes through a single continuous audio
+stream.
+"""
+import numpy as np
+import time
+from audio import CHANNELS, SAMPLE_RATE
+from collections import deque
+
+# sounddevice is needed to stream audio. Without it (or without the PortAudio
+# library it uses), the sequencer plays every note with simpleaudio instead.
+try:
+    import sounddevice
+except (ImportError, OSError):
+    sounddevice = None
+
+
+def mixer_available():
+    """
+    Return True if audio can be streamed through a mixer.
+    """
+    return sounddevice is not None
+
+
+class MixerVoice:
+    """
+    A mixer voice is a single sound played by the mixer. Like simpleaudio's
+    play objects, it can be stopped and asked whether it is still playing.
+    """
+
+    def __init__(self, start_frame, frames, gain):
+        """
+        Initialize a voice that starts at the given frame of the mixer's
+        output.
+        """
+        self.start_frame = start_frame
+        self.frames = frames
+        self.gain = gain
+        self.stopped = False
+
+    def stop(self):
+        """
+        Stop playing this voice. This can be called from any thread.
+        """
+        self.stopped = True
+
+    def is_playing(self):
+        """
+        Return True if this voice is waiting to start or still playing.
+        """
+        return not self.stopped
+
+
+class Mixer:
+    """
+    The mixer renders all playing voices into fixed-size blocks of audio and
+    streams those blocks to the audio device. Notes are started at the frame
+    that corresponds to the time they should be played, so timing is sample
+    accurate regardless of when the sequencer gets around to triggering them.
+    """
+
+    def __init__(self, block_size=256, latency_blocks=2, sample_rate=SAMPLE_RATE):
+        """
+        Initialize the mixer. Notes are triggered at about the time they
+        should be heard, but reach the audio device only after its output
+        latency. So every note is delayed by that latency plus latency_blocks
+        blocks, which leaves room for notes that are triggered slightly late
+        to still start at the right frame.
+        """
+        self.block_size = block_size
+        self.headroom = latency_blocks * block_size
+        self.latency = self.headroom
+        self.sample_rate = sample_rate
+        self.voices = []
+        self.new_voices = deque()
+        self.frame = 0
+        # A frame of the output and the time on the monotonic clock at which
+        # it is heard, from which the frames of other times are computed.
+        self.anchor = (0, time.monotonic())
+        self.stream = None
+
+    def start(self):
+        """
+        Start streaming audio. Return False if no audio device could be
+        opened.
+        """
+        self.voices = []
+        self.new_voices.clear()
+        self.frame = 0
+        self.anchor = (0, time.monotonic())
+
+        try:
+            self.stream = sounddevice.OutputStream(
+                samplerate=self.sample_rate,
+                blocksize=self.block_size,
+                channels=CHANNELS,
+                dtype="float32",
+                callback=self.callback,
+            )
+            self.stream.start()
+        except sounddevice.PortAudioError:
+            self.stop()
+            return False
+
+        self.set_output_delay(self.stream.latency)
+        return True
+
+    def set_output_delay(self, delay):
+        """
+        Make sure notes are delayed long enough for an audio device that plays
+        a block the given number of seconds after it is rendered. The latency
+        only ever grows, so notes never jump back in time.
+        """
+        latency = round(delay * self.sample_rate) + self.headroom
+        self.latency = max(self.latency, latency)
+
+    def stop(self):
+        """
+        Stop streaming audio.
+        """
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def trigger(self, frames, play_time=None, gain=1):
+        """
+        Start playing the given frames at the given time on the monotonic
+        clock, or as soon as possible if no time is given. The frames are an
+        array with a row per frame and a column per channel, which may hold
+        integers, such as a view of a 16 bit WAV file. They are multiplied by
+        gain while mixing. Return the MixerVoice that plays them. This can be
+        called from any thread.
+        """
+        if play_time is None:
+            play_time = time.monotonic()
+
+        anchor_frame, anchor_time = self.anchor
+        start_frame = anchor_frame + round((play_time - anchor_time) * self.sample_rate)
+        voice = MixerVoice(start_frame + self.latency, frames, np.float32(gain))
+        self.new_voices.append(voice)
+        return voice
+
+    def render_block(self, n_frames):
+        """
+        Mix the next n_frames frames of all voices into a block and return
+        it. Voices that have finished playing or have been stopped are
+        removed.
+        """
+        block_start = self.frame
+        block_end = block_start + n_frames
+
+        while len(self.new_voices) > 0:
+            voice = self.new_voices.popleft()
+            # Voices that should have started already start right away.
+            voice.start_frame = max(voice.start_frame, block_start)
+            self.voices.append(voice)
+
+        block = np.zeros((n_frames, CHANNELS), dtype=np.float32)
+        playing = []
+
+        for voice in self.voices:
+            if voice.stopped:
+                continue
+
+            start_frame, samples, gain = voice.start_frame, voice.frames, voice.gain
+
+            if start_frame >= block_end:
+                playing.append(voice)
+                continue
+
+            block_offset = max(start_frame - block_start, 0)
+            sample_offset = max(block_start - start_frame, 0)
+            n = min(n_frames - block_offset, len(samples) - sample_offset)
+            block[block_offset : block_offset + n] += (
+                samples[sample_offset : sample_offset + n] * gain
+            )
+
+            if sample_offset + n < len(samples):
+                playing.append(voice)
+            else:
+                voice.stopped = True
+
+        self.voices = playing
+        self.frame = block_end
+        return np.clip(block, -1, 1, out=block)
+
+    def callback(self, output, n_frames, time_info, status):
+        """
+        Fill the audio device's buffer. This is called by sounddevice from its
+        own thread whenever a new block is needed.
+
+        Before rendering, the block's first frame is anchored to the time at
+        which the device will play it, so the audio clock drifting away from
+        the monotonic clock doesn't shift the timing of notes. Devices that
+        don't report this time keep counting frames from the last anchor.
+        """
+        if time_info.outputBufferDacTime > 0 and time_info.currentTime > 0:
+            delay = time_info.outputBufferDacTime - time_info.currentTime
+            self.anchor = (self.frame, time.monotonic() + delay)
+            # The device may take longer than the latency it reported.
+            self.set_output_delay(delay)
+
+        output[:] = self.render_block(n_frames)
+
+
+if __name__ == "__main__":
+    print("Please run from main.py.")
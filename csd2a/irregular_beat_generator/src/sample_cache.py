@@ -0,0 +1,360 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+sample_cache.py:
+Contains a cache that makes sure every audio file is only loaded once, so all
+tracks and sequencers that use the same file share its audio data.
+"""
+import hashlib
+import json
+import numpy as np
+import simpleaudio as sa
+import threading
+from audio import (
+    CHANNELS,
+    SAMPLE_RATE,
+    SAMPLE_WIDTH,
+    map_wave_file,
+    pcm_frames,
+    pcm_to_mixing_format,
+    velocity_to_gain,
+    write_wave_file,
+)
+from collections import OrderedDict
+from os import makedirs, replace, stat
+from os.path import basename, dirname, getmtime, isfile, join
+
+# Directory, next to the original audio files, in which copies of audio files
+# converted to the mixing format are stored.
+NORMALIZED_DIRECTORY = ".normalized"
+# File in that directory that stores the hash of every original audio file.
+INDEX_FILE = "index.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file_path):
+    """
+    Return the SHA-1 hash of the given file's contents as a hexadecimal
+    string. The file is read in chunks, so it is never loaded as a whole.
+    """
+    digest = hashlib.sha1()
+
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_index(index_path):
+    """
+    Return the index of hashes stored at the given path, or an empty index if
+    it does not exist or can not be read.
+    """
+    try:
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def normalized_file_path(file_path):
+    """
+    Return the path of the converted copy of the given audio file. Copies are
+    named after a hash of the original file's contents, so a copy is reused
+    for as long as the file is unchanged, even if it is moved or renamed. The
+    hash of every file is stored in an index together with the file's size
+    and modification time, so a file is only read again when it changes.
+    """
+    directory = join(dirname(file_path), NORMALIZED_DIRECTORY)
+    index_path = join(directory, INDEX_FILE)
+    index = read_index(index_path)
+    file_stat = stat(file_path)
+    entry = [file_stat.st_size, file_stat.st_mtime_ns]
+    name = basename(file_path)
+
+    if name in index and index[name][:2] == entry:
+        digest = index[name][2]
+    else:
+        digest = file_digest(file_path)
+        index[name] = entry + [digest]
+        makedirs(directory, exist_ok=True)
+
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+
+        replace(index_path + ".tmp", index_path)
+
+    return join(directory, digest + ".wav")
+
+
+def normalize_wave_file(file_path, pcm_data, num_channels, bytes_per_sample, rate):
+    """
+    Convert the given PCM data of an audio file to the mixing format and
+    write it to a 16 bit WAV file, unless this was done before. Return the
+    path of the converted file.
+    """
+    normalized_path = normalized_file_path(file_path)
+
+    if not isfile(normalized_path):
+        makedirs(dirname(normalized_path), exist_ok=True)
+        array = pcm_to_mixing_format(pcm_data, num_channels, bytes_per_sample, rate)
+        # Write to a temporary file first, so an interrupted conversion never
+        # leaves a partial file behind.
+        write_wave_file(normalized_path + ".tmp", array)
+        replace(normalized_path + ".tmp", normalized_path)
+
+    return normalized_path
+
+
+class Sample:
+    """
+    A sample holds the audio of a single audio file. Files that are not in the
+    mixing format (see audio.py) are converted once and the converted copy is
+    stored on disk (see normalize_wave_file), so playback never has to
+    convert audio. The PCM data is memory-mapped rather than read, so only the
+    parts of a sample bank that are actually played are loaded into memory.
+    The float array used for rendering is created when it is first needed,
+    as are the WaveObjects used by simpleaudio, unless they are prepared
+    ahead of time with prepare_wave_objects.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a sample by memory-mapping the given audio file, or its
+        converted copy.
+        """
+        self.path = path
+        wave_data = map_wave_file(path)
+
+        if wave_data[1:] != (CHANNELS, SAMPLE_WIDTH, SAMPLE_RATE):
+            wave_data = map_wave_file(normalize_wave_file(path, *wave_data))
+
+        (
+            self.pcm_data,
+            self.num_channels,
+            self.bytes_per_sample,
+            self.sample_rate,
+        ) = wave_data
+        self.wave_objects = {}  # WaveObjects by the gain they are scaled by.
+        self.array = None
+        # The SampleCache this sample was loaded by, and its key in that cache.
+        self.cache = None
+        self.cache_key = None
+
+    def __str__(self):
+        """
+        Return a string representation of this sample.
+        """
+        return "<Sample object. Path: {}.>".format(self.path)
+
+    def get_wave_object(self, gain=1):
+        """
+        Return a simpleaudio WaveObject that plays this sample scaled by the
+        given gain. Scaled copies of the audio are made once per gain and
+        kept, so playing a note at a lower volume costs no more than playing
+        it at full volume. At a gain of 1, the WaveObject refers to the mapped
+        PCM data instead of a copy of it.
+        """
+        wave_object = self.wave_objects.get(gain)
+
+        if wave_object is None:
+            if gain == 1:
+                pcm_data = self.pcm_data
+            else:
+                frames = pcm_frames(
+                    self.pcm_data, self.num_channels, self.bytes_per_sample
+                )[0]
+                pcm_data = np.round(frames * gain).astype(frames.dtype)
+
+            wave_object = sa.WaveObject(
+                pcm_data,
+                self.num_channels,
+                self.bytes_per_sample,
+                self.sample_rate,
+            )
+            self.wave_objects[gain] = wave_object
+
+            if gain != 1:
+                self.grown()
+
+        return wave_object
+
+    def prepare_wave_objects(self, velocities):
+        """
+        Create the WaveObjects for the gains of the given velocities (see
+        velocity_to_gain), so no audio has to be scaled when notes with those
+        velocities are played. Silent notes are never played, so no
+        WaveObject is made for a gain of 0.
+        """
+        for velocity in set(velocities):
+            gain = velocity_to_gain(velocity)
+
+            if gain > 0:
+                self.get_wave_object(gain)
+
+    def get_array(self):
+        """
+        Return this sample's audio as a float32 array in the mixing format.
+        """
+        array = self.array
+
+        if array is None:
+            array = pcm_to_mixing_format(
+                self.pcm_data,
+                self.num_channels,
+                self.bytes_per_sample,
+                self.sample_rate,
+            )
+            self.array = array
+            self.grown()
+
+        return array
+
+    def grown(self):
+        """
+        Let the cache this sample was loaded by know that it holds more
+        memory, so the cache can stay within its size.
+        """
+        if self.cache is not None:
+            self.cache.trim(self)
+
+    def release(self):
+        """
+        Free the memory held by this sample's scaled and converted copies of
+        its audio. They are made again if they are needed again.
+        """
+        self.wave_objects = {}
+        self.array = None
+
+    def get_frames(self):
+        """
+        Return this sample's frames and the gain that scales them to between
+        -1 and 1, for the mixer. The frames are a view of the mapped PCM data,
+        so nothing is copied.
+        """
+        return pcm_frames(self.pcm_data, self.num_channels, self.bytes_per_sample)
+
+    def get_size(self):
+        """
+        Return the number of bytes of memory held by this sample. Mapped PCM
+        data is not counted, as the operating system loads and unloads it as
+        needed.
+        """
+        size = 0 if self.array is None else self.array.nbytes
+
+        # Copy the items, as another thread may be adding a WaveObject.
+        for gain, wave_object in list(self.wave_objects.items()):
+            if gain != 1:
+                size += wave_object.audio_data.nbytes
+
+        return size
+
+    def play(self, gain=1):
+        """
+        Play this sample with simpleaudio at the given gain and return the
+        play object.
+        """
+        return self.get_wave_object(gain).play()
+
+
+class SampleCache:
+    """
+    A sample cache keeps the samples of recently used audio files in memory.
+    Samples are identified by the path and modification time of their audio
+    file, so a sample is reloaded when its file changes. Whenever a sample
+    creates a copy of its audio, the cache checks its size. When the samples
+    in the cache take up more than max_size bytes of memory (see
+    Sample.get_size), the least recently used samples that hold copies
+    release them (see Sample.release) and are removed. Samples that are still
+    used by a track stay valid after they are removed from the cache, and
+    make their copies again when they need them.
+    """
+
+    def __init__(self, max_size=256 * 1024 * 1024):
+        """
+        Initialize an empty cache that holds at most max_size bytes of audio.
+        """
+        self.max_size = max_size
+        self.samples = OrderedDict()
+        # Samples are loaded and grow on the input, play and render threads.
+        self.lock = threading.RLock()
+
+    def get(self, file_path):
+        """
+        Return the sample for the given audio file. Load it if it is not in
+        the cache yet.
+        """
+        key = (file_path, getmtime(file_path))
+
+        with self.lock:
+            if key in self.samples:
+                self.samples.move_to_end(key)
+                return self.samples[key]
+
+            # Remove samples loaded from an older version of the file.
+            for old_key in [
+                old_key for old_key in self.samples if old_key[0] == file_path
+            ]:
+                self.samples.pop(old_key).release()
+
+            sample = Sample(file_path)
+            sample.cache = self
+            sample.cache_key = key
+            self.samples[key] = sample
+            return sample
+
+    def trim(self, sample):
+        """
+        Mark the given sample, which has just grown, as the most recently used
+        sample, and remove the least recently used samples until the cache is
+        no larger than max_size. The given sample is always kept, even if it
+        is larger than max_size. A sample that was removed before is added
+        again, as it is in use.
+        """
+        with self.lock:
+            if self.samples.get(sample.cache_key) is sample:
+                self.samples.move_to_end(sample.cache_key)
+            elif sample.cache_key not in self.samples:
+                self.samples[sample.cache_key] = sample
+
+            size = self.get_size()
+
+            for key in list(self.samples):
+                if size <= self.max_size:
+                    break
+
+                old_sample = self.samples[key]
+                old_size = old_sample.get_size()
+
+                # Samples without copies are kept, as removing them frees
+                # nothing.
+                if old_sample is sample or old_size == 0:
+                    continue
+
+                del self.samples[key]
+                size -= old_size
+                old_sample.release()
+
+    def get_size(self):
+        """
+        Return the number of bytes of audio held by the samples in the cache.
+        """
+        with self.lock:
+            return sum(sample.get_size() for sample in self.samples.values())
+
+
+# The cache shared by all sequencers and tracks in this process.
+sample_cache = SampleCache()
+
+
+def load_sample(file_path):
+    """
+    Load the sample for the given audio file from the shared sample cache.
+    """
+    return sample_cache.get(file_path)
+
+
+if __name__ == "__main__":
+    print("Please run from main.py.")
@@ -7,20 +7,40 @@ On:             October 21, 2023
 sequencer.py:
 Implement all classes necessary to run a sequencer.
 """
-import simpleaudio as sa
+import asyncio
 import time
+from audio import SAMPLE_RATE, mix, velocity_to_gain, write_wave_file
+from array import array
+from bisect import bisect_left
+from copy import copy
+from heapq import heappop, heappush
 from os.path import isfile
-from markov import MarkovChain
-from helpers import rhythm_file_path
+from queue import Empty
+from markov import ChainCache
+from mixer import Mixer, mixer_available
+from sample_cache import load_sample
+from timing import TimingStats
+from voices import MAX_TRACK_VOICES, MAX_VOICES, VoicePool
+from helpers import chain_file_path, rhythm_file_path
 from midiutil import MIDIFile
 
+# The next loop of a track is scheduled this many sixteenths before the
+# current loop ends, between two ticks, so scheduling it never delays the
+# notes at the start of the loop.
+REFILL_AHEAD = 0.5
+
 
 class NoteEvent:
     """
     Note events hold all relevant information on rhythmic notes, such as
-    velocity, timestamp and duration.
+    velocity, timestamp and duration. Tracks store their notes in arrays (see
+    SequencerTrack), and only create note events when they are asked for a
+    note. A note event is a copy of a note: changing it does not change the
+    track.
     """
 
+    __slots__ = ["track", "timestamp", "duration", "velocity"]
+
     def __init__(self, track, timestamp, duration, velocity):
         """
         Initialize a note object given the timestamp in 16th notes, the audio
@@ -30,9 +50,7 @@ class NoteEvent:
         self.track = track
         self.timestamp = timestamp
         self.duration = duration  # Duration in 16th notes.
-        self.velocity = (
-            velocity  # NOTE: unused, but might be useful in future iterations.
-        )
+        self.velocity = velocity
 
     def __str__(self):
         """
@@ -56,13 +74,26 @@ class NoteEvent:
         """
         return self.timestamp == other.timestamp
 
-    def play(self):
+    def play(self, play_time=None):
         """
-        Play this event's sound if current time exceeds this note event's
-        timestamp.
+        Play this event's sound at a volume set by its velocity. If the
+        sequencer has a mixer, the sound is started at the given time on the
+        monotonic clock. Otherwise, it is played right away with simpleaudio.
+        Notes with a velocity of 0 are silent, so they are not played at all.
         """
-        # NOTE velocity could be used here in a future version.
-        self.track.audio_file.play()
+        mixer = self.track.sequencer.mixer
+        gain = velocity_to_gain(self.velocity)
+
+        if gain == 0:
+            return
+
+        if mixer is not None:
+            frames, frames_gain = self.track.audio_file.get_frames()
+            voice = mixer.trigger(frames, play_time, frames_gain * gain)
+        else:
+            voice = self.track.audio_file.play(gain)
+
+        self.track.add_voice(voice)
 
 
 class SequencerTrack:
@@ -72,19 +103,31 @@ class SequencerTrack:
     single audio file. Sequencer tracks are mono.
     """
 
-    def __init__(self, sequencer, length, audio_file, name):
+    def __init__(self, sequencer, length, audio_file, name, groups=None):
         """
-        Initialize a sequencer track given its length and an audio file.
+        Initialize a sequencer track given its length and an audio file, which
+        is a Sample loaded with load_sample. The track can be added to groups
+        of tracks, given as a list of group names.
         """
         self.sequencer = sequencer
         self.length = length  # Length in sixteenth notes.
-        self.note_events = []
+        # The timestamps, durations and velocities of the notes are stored in
+        # separate arrays, sorted by timestamp, which takes far less memory
+        # than a NoteEvent object per note.
+        self.timestamps = array("q")
+        self.durations = array("d")
+        self.velocities = array("B")
         self.next_rhythm = None
         self.next_length = None
         self.audio_file = audio_file
-        self.note_index = 0
-        self.sixteenth_index = 0
+        self.bar_start = 0  # Sixteenth at which the current loop started.
         self.name = name
+        self.voices = VoicePool(MAX_TRACK_VOICES)
+        self.choke = False  # Stop the previous note when a new one starts.
+        self.groups = groups or []
+        # The compiled Markov chain this track's rhythms are generated with. If
+        # None, the sequencer's chain for the current meter is used.
+        self.chain = None
 
     def __str__(self):
         """
@@ -92,63 +135,120 @@ class SequencerTrack:
         """
         return self.name + " track"
 
+    def get_note(self, index):
+        """
+        Return a note event for the note at the given index.
+        """
+        return NoteEvent(
+            self,
+            self.timestamps[index],
+            self.durations[index],
+            self.velocities[index],
+        )
+
+    def get_notes(self):
+        """
+        Yield a note event for every note, in order of their timestamps.
+        """
+        for index in range(len(self.timestamps)):
+            yield self.get_note(index)
+
+    def find_note(self, timestamp):
+        """
+        Return the index of the note at the given timestamp, or None if there
+        is no note at that timestamp.
+        """
+        index = bisect_left(self.timestamps, timestamp)
+
+        if index < len(self.timestamps) and self.timestamps[index] == timestamp:
+            return index
+
+        return None
+
     def add_note(self, timestamp, duration, velocity, replace=False):
         """
-        Add a note event. If a note event exists at the given timestamp and
-        replace is False, do not insert the new note event. If replace is True,
-        replace the old note event with the new note event.
+        Add a note. If a note exists at the given timestamp and replace is
+        False, do not insert the new note. If replace is True, replace the old
+        note with the new note. The position of the note is found by
+        bisecting, so the notes stay sorted without sorting them again.
         """
+        index = self.find_note(timestamp)
 
-        if any(note_event.timestamp == timestamp for note_event in self.note_events):
+        if index is not None:
             if replace:
-                self.note_events = list(
-                    filter(
-                        lambda note_event: note_event.timestamp != timestamp,
-                        self.note_events,
-                    )
-                )
-            else:
-                return
+                self.durations[index] = duration
+                self.velocities[index] = velocity
+                self.prepare_velocities([velocity])
 
-        note_event = NoteEvent(self, timestamp, duration, velocity)
-        self.note_events.append(note_event)
-        self.note_events.sort()
+            return
 
-    def swap_rhythms(self):
+        index = bisect_left(self.timestamps, timestamp)
+        self.timestamps.insert(index, timestamp)
+        self.durations.insert(index, duration)
+        self.velocities.insert(index, velocity)
+        self.prepare_velocities([velocity])
+
+    def remove_note(self, timestamp):
         """
-        If a next rhythm exists, edit the list of note events to reflect the
-        new rhythm.
+        Remove the note at the given timestamp, if there is one.
         """
-        self.note_events = []
+        index = self.find_note(timestamp)
 
-        for timestamp in self.next_rhythm:
-            self.add_note(timestamp, 1, 100)
+        if index is not None:
+            del self.timestamps[index]
+            del self.durations[index]
+            del self.velocities[index]
 
-        self.next_rhythm = None
+    def set_notes(self, timestamps, duration=1, velocity=100):
+        """
+        Replace all notes with notes at the given timestamps, all with the
+        same duration and velocity.
+        """
+        self.timestamps = array(self.timestamps.typecode, sorted(set(timestamps)))
+        self.durations = array("d", [duration]) * len(self.timestamps)
+        self.velocities = array("B", [velocity]) * len(self.timestamps)
+        self.prepare_velocities([velocity])
+
+    def prepare_velocities(self, velocities):
+        """
+        If notes are played with simpleaudio, make sure this track's sample
+        has been scaled for the given velocities, so that doesn't have to
+        happen when a note is played.
+        """
+        if self.sequencer.mixer is None:
+            self.audio_file.prepare_wave_objects(velocities)
 
-    def step(self):
+    def add_voice(self, voice):
         """
-        Step the sequencer track one sixteenth.
+        Keep track of a voice that plays one of this track's notes, so the
+        number of voices of this track and of the sequencer stays limited. If
+        this track chokes, its previous voices are stopped first.
         """
-        self.sixteenth_index = (self.sixteenth_index + 1) % self.length
+        if self.choke:
+            self.voices.stop_all()
+
+        self.voices.add(voice)
+        self.sequencer.voices.add(voice)
 
-        if (
-            len(self.note_events) > 0
-            and self.note_events[self.note_index].timestamp == self.sixteenth_index
-        ):
-            self.note_events[self.note_index].play()
-            self.note_index = (self.note_index + 1) % len(self.note_events)
+    def swap_rhythms(self):
+        """
+        If a next rhythm exists, edit the list of note events to reflect the
+        new rhythm.
+        """
+        self.set_notes(self.next_rhythm)
+        self.next_rhythm = None
 
-        if (
-            len(self.note_events) > 0
-            and self.note_events[self.note_index].timestamp >= self.length
-        ):
-            self.note_index = 0
+    def end_bar(self):
+        """
+        Move on to the next loop of the rhythm. Switch to the next rhythm and
+        length if they have been set.
+        """
+        self.bar_start += self.length
 
-        if self.note_index == 0 and self.next_rhythm:
+        if self.next_rhythm is not None:
             self.swap_rhythms()
 
-        if self.note_index == 0 and self.next_length:
+        if self.next_length:
             self.length = self.next_length
             self.next_length = None
 
@@ -173,16 +273,28 @@ class Sequencer:
         the sequencer.
         """
         self.tracks = []
+        self.track_indices = {}  # Index in tracks of every track, by name.
+        self.groups = {}  # Lists of the tracks in each group, by group name.
+        self.new_tracks = {}  # Tracks waiting for the play thread, by name.
+        self.mixer = Mixer() if mixer_available() else None
+        self.voices = VoicePool(MAX_VOICES)
         self.meter = (7, 8)
-        self.markov_chain = MarkovChain()
-        self.markov_chain.from_rhythm_file(rhythm_file_path(self.meter))
-        self.initialize_tracks()
+        self.markov_order = 1
+        self.chain_cache = ChainCache(self.markov_order)
+        # Track chains are kept apart, so they never push the meters' chains
+        # and what they learned out of the cache.
+        self.track_chain_cache = ChainCache(self.markov_order)
+        self.load_chains([(7, 8), (5, 4)])
+        self.compiled_chain = self.get_chain(self.meter)
         self.set_bpm(120)
         self.queue_incoming = queue_incoming
         self.queue_outgoing = queue_outgoing
         self.start_time = None
         self.done_playing = False
         self.play_index = 0
+        self.event_heap = []
+        self.timing = TimingStats()
+        self.initialize_tracks()
 
     def __str__(self):
         """
@@ -192,6 +304,26 @@ class Sequencer:
             len(self.tracks), self.meter[0], self.meter[1], self.bpm
         )
 
+    def load_chains(self, meters):
+        """
+        Build the Markov chains for the given meters ahead of time, so
+        switching to one of these meters while playing doesn't require reading
+        a rhythm file.
+        """
+        for meter in meters:
+            self.get_chain(meter)
+
+    def get_chain(self, meter):
+        """
+        Get the compiled Markov chain for the given meter from the cache. If a
+        binary chain file for the meter exists, it is used instead of the
+        rhythm file.
+        """
+        if isfile(chain_file_path(meter)):
+            return self.chain_cache.get(chain_file_path(meter))
+
+        return self.chain_cache.get(rhythm_file_path(meter))
+
     def get_sequence_length(self):
         """
         Calculate the length of the sequence in 16th notes.
@@ -200,7 +332,7 @@ class Sequencer:
 
     def initialize_tracks(self):
         """
-        Initialize tracks for high, mid and low.
+        Initialize tracks for high, mid and low, in the group "drums".
         """
 
         for track_name in ["high", "mid", "low"]:
@@ -210,9 +342,9 @@ class Sequencer:
             if not isfile(audio_file_path):
                 raise Exception('Audio file "{}" not found.'.format(audio_file_path))
 
-            audio_file = sa.WaveObject.from_wave_file(audio_file_path)
-            self.tracks.append(
-                SequencerTrack(self, self.get_sequence_length(), audio_file, track_name)
+            audio_file = load_sample(audio_file_path)
+            self.add_track(
+                self.get_sequence_length(), audio_file, track_name, ["drums"]
             )
 
     def set_bpm(self, bpm):
@@ -227,71 +359,234 @@ class Sequencer:
         Set the sequencer's and all tracks' meter to numerator/denominator (eg.
         a 7/8 meter has a numerator of 7 and a denominator of 8)
         """
-        self.meter[0] = numerator
-        self.meter[1] = denominator
-        self.markov_chain.from_rhythm_file(rhythm_file_path(self.meter))
+        self.meter = (numerator, denominator)
+        self.compiled_chain = self.get_chain(self.meter)
 
         for track in self.tracks:
             track.length = self.get_sequence_length()  # Track length in 16ths
 
-    def add_track(self, length, audio_file, name):
+    def add_track(self, length, audio_file, name, groups=None):
         """
-        Add a new track to this sequencer.
+        Add a new track to this sequencer, optionally in the given groups.
+        Track names have to be unique. If the sequencer is playing, the track
+        is handed to the play thread through the command queue and starts
+        playing at the next sixteenth after it is received.
         """
-        track = SequencerTrack(self, length, audio_file, name)
-        self.tracks.append(track)
+        if name in self.track_indices or name in self.new_tracks:
+            raise Exception('A track named "{}" already exists.'.format(name))
+
+        track = SequencerTrack(self, length, audio_file, name, groups)
+
+        if self.start_time is None:
+            self.register_track(track)
+        else:
+            self.new_tracks[name] = track
+            self.queue_incoming.put_nowait(("add_track", name))
+
         return track
 
+    def start_track(self, track_name):
+        """
+        Add a track that was added while playing and schedule its first loop
+        at the next sixteenth.
+        """
+        track = self.new_tracks[track_name]
+        self.register_track(track)
+        del self.new_tracks[track_name]
+        track.bar_start = self.play_index
+        self.schedule_bar(len(self.tracks) - 1)
+
+    def register_track(self, track):
+        """
+        Append a track to the list of tracks and add it to the lookup tables
+        of track names and groups.
+        """
+        self.track_indices[track.name] = len(self.tracks)
+        self.tracks.append(track)
+
+        for group in track.groups:
+            self.groups.setdefault(group, []).append(track)
+
     def get_track(self, track_name):
         """
-        Get a track by name.
+        Get a track by name, including tracks that are waiting to be added
+        by the play thread. Return None if there is no such track.
+        """
+        index = self.track_indices.get(track_name)
+
+        if index is None:
+            return self.new_tracks.get(track_name)
+
+        return self.tracks[index]
+
+    def get_tracks(self, selection):
+        """
+        Return a list of the tracks selected by the given string: "all" for
+        all tracks, "group:<name>" for the tracks in a group, or the name of a
+        single track. The list is empty if no tracks match.
+        """
+        if selection == "all":
+            return list(self.tracks)
+
+        if selection.startswith("group:"):
+            return list(self.groups.get(selection[len("group:") :], []))
+
+        track = self.get_track(selection)
+        return [] if track is None else [track]
+
+    def set_track_chain(self, track_name, file_path):
+        """
+        Generate the given track's rhythms with its own Markov chain, built
+        from the given rhythm file or loaded from the given chain file. Every
+        onset of that chain other than a rest becomes a note of the track.
         """
-        return next((track for track in self.tracks if track.name == track_name), None)
+        self.get_track(track_name).chain = self.track_chain_cache.get(file_path)
 
     def handle_bpm_command(self, bpm):
         """
         Set the sequencer's bpm and communicate to the live coding environment
         that it can continue.
         """
+        # Keep the current position in the rhythm, so the sixteenths that have
+        # not been played yet follow at the new tempo.
+        now = time.monotonic()
+        position = (now - self.start_time) / self.sixteenth_duration
         self.set_bpm(bpm)
-        self.start_time = time.time() + 0.001
-        self.play_index = 1
-        self.queue_outgoing.put("done")
+        self.start_time = now - position * self.sixteenth_duration
+        self.queue_outgoing.put_nowait("done")
+
+    def get_constraints(self):
+        """
+        Return a dictionary mapping positions in 16th notes to the states the
+        Markov chain has to be in at those positions. This forces a snare on
+        the 4th 8th note in 5/4 or on the 5th 8th note in 7/8.
+        """
+        if self.meter == (5, 4):
+            return {8: "mid"}
+
+        if self.meter == (7, 8):
+            return {10: "mid"}
+
+        return {}
+
+    def get_chain_parts(self):
+        """
+        Return the set of track names that are parts of the onsets of the
+        current meter's Markov chain (eg. "high" and "low" for "high&low").
+        """
+        return {
+            part
+            for symbol in set(self.compiled_chain.symbols)
+            for part in symbol.split("&")
+            if part != ""
+        }
 
     def generate_rhythms(self, track_names, length):
         """
-        Regenereate the given rhythms with a single markov chain.
+        Regenereate the given rhythms with a single markov chain. Instead of
+        overriding the chain's state at constrained positions, the rhythm is
+        sampled from the chain conditioned on the constraints, so transitions
+        around those positions keep their probabilities.
         """
-        new_rhythms = {}
+        states = self.compiled_chain.sample_constrained(length, self.get_constraints())
+        return self.rhythms_from_states(states, track_names)
 
-        for track_name in track_names:
-            new_rhythms[track_name] = []
+    def generate_rhythm_batch(self, n, length=None, rng=None):
+        """
+        Generate n candidate rhythms at once. Return a NumPy array of shape
+        (n, length) holding the compiled chain's state ids. The length
+        defaults to the length of the current sequence.
+        """
+        if length is None:
+            length = self.get_sequence_length()
+
+        return self.compiled_chain.sample_batch(n, length, self.get_constraints(), rng)
 
-        self.markov_chain.state = None
+    def rhythms_from_states(self, states, track_names):
+        """
+        Convert a sequence of state ids, such as one row of the array returned
+        by generate_rhythm_batch, to a dictionary of timestamps per track.
+        """
+        new_rhythms = {track_name: [] for track_name in track_names}
 
-        for i in range(length):
-            self.markov_chain.step()
+        for i, state in enumerate(states):
+            onset = self.compiled_chain.symbols[state]
 
-            # Force a snare on the 4th 8th note in 5/4 or on the 5th 8th note
-            # in 7/8
-            if i == 8 and self.meter == (5, 4) or i == 10 and self.meter == (7, 8):
-                self.markov_chain.set_state("mid")
+            if onset == "":
+                continue
 
-            if self.markov_chain.state.name in new_rhythms.keys():
-                new_rhythms[self.markov_chain.state.name].append(i)
+            # Onsets of several parts are named like "high&low".
+            for part in onset.split("&"):
+                if part in new_rhythms:
+                    new_rhythms[part].append(i)
 
         return new_rhythms
 
-    def regenerate_rhythm(self, track_name):
+    def generate_track_rhythm(self, track, length):
         """
-        Generate a new rhythm for the given track.
+        Generate a rhythm for a track that has its own Markov chain. Return a
+        list of timestamps.
         """
-        self.markov_chain.state = None
-        track_names = [track_name] if track_name != "all" else ["high", "mid", "low"]
+        states = track.chain.sample_constrained(length, {})
+        return [i for i, state in enumerate(states) if track.chain.symbols[state] != ""]
+
+    def regenerate_rhythm(self, selection):
+        """
+        Generate new rhythms for the tracks selected by the given string (see
+        get_tracks). Tracks without their own Markov chain are generated
+        together with the chain of the current meter, so they fit together.
+        Tracks that have no chain of their own and are not a part of the
+        meter's chain keep their rhythm.
+        """
+        self.compiled_chain.state = None
+        tracks = self.get_tracks(selection)
+        parts = self.get_chain_parts()
+        track_names = [
+            track.name
+            for track in tracks
+            if track.chain is None and track.name in parts
+        ]
         new_rhythms = self.generate_rhythms(track_names, self.get_sequence_length())
 
-        for track_name in new_rhythms.keys():
-            self.get_track(track_name).set_next_rhythm(new_rhythms[track_name])
+        for track in tracks:
+            if track.chain is not None:
+                track.set_next_rhythm(
+                    self.generate_track_rhythm(track, self.get_sequence_length())
+                )
+            elif track.name in new_rhythms:
+                track.set_next_rhythm(new_rhythms[track.name])
+
+    def get_current_onsets(self):
+        """
+        Return the rhythm that is currently playing as a list of onsets, named
+        the same way as the onsets in the rhythm files (eg. "high&low" for a
+        hihat and a kick simultaneously, an empty string for a rest).
+        """
+        onsets = [""] * self.get_sequence_length()
+        parts = self.get_chain_parts()
+
+        for track in self.tracks:
+            # Only the parts of the meter's chain are learned by it.
+            if track.chain is not None or track.name not in parts:
+                continue
+
+            for timestamp in track.timestamps:
+                if timestamp >= len(onsets):
+                    continue
+
+                onset = onsets[timestamp]
+                onsets[timestamp] = (
+                    track.name if onset == "" else onset + "&" + track.name
+                )
+
+        return onsets
+
+    def keep_rhythm(self):
+        """
+        Have the Markov chain of the current meter learn the transitions of the
+        rhythm that is currently playing.
+        """
+        self.compiled_chain.learn(self.get_current_onsets())
 
     def export_midi(self, file_name):
         """
@@ -303,23 +598,23 @@ class Sequencer:
         time = 0
         midi_file.addTrackName(midi_track, time, "Rhythm Track")
         midi_file.addTempo(midi_track, time, self.bpm)
-        pitch = 48
 
-        for track_name in ["low", "mid", "high"]:
-            track = self.get_track(track_name)
+        # Separate pitch for each track in the sequencer, starting at 48 for
+        # the last track. When the pitches up to 127 have been used, the next
+        # tracks continue on the next channel.
+        for i, track in enumerate(reversed(self.tracks)):
+            channel, pitch = divmod(i, 80)
 
-            for note_event in track.note_events:
+            for note_event in track.get_notes():
                 midi_file.addNote(
                     midi_track,
-                    0,
-                    pitch,
+                    channel,
+                    pitch + 48,
                     note_event.timestamp / 4,
                     0.25,
                     note_event.velocity,
                 )
 
-            pitch += 1  # Separate pitch for each track in the sequencer.
-
         with open(file_name, "wb") as output_file:
             midi_file.writeFile(output_file)
 
@@ -329,8 +624,8 @@ class Sequencer:
         """
         # Set new meter
         self.meter = (5, 4) if self.meter == (7, 8) else (7, 8)
-        # Generate new markov chain using meter
-        self.markov_chain.from_rhythm_file(rhythm_file_path(self.meter))
+        # Get the markov chain for the new meter
+        self.compiled_chain = self.get_chain(self.meter)
         # Regenerate mid and low tracks
         self.regenerate_rhythm("mid")
         self.regenerate_rhythm("low")
@@ -338,7 +633,6 @@ class Sequencer:
         # Extend high track if necessary
         if self.meter == (5, 4):
             track = self.get_track("high")
-            self.markov_chain.set_state("high")
             # Add 6 16th notes to go from 7/8 to 5/4.
             extra_notes = self.generate_rhythms(["high"], 6)["high"]
 
@@ -350,7 +644,108 @@ class Sequencer:
         for track in self.tracks:
             track.next_length = self.get_sequence_length()
 
-        self.queue_outgoing.put("done")
+    def copy_for_rendering(self):
+        """
+        Return a copy of this sequencer that can be played offline without
+        affecting this sequencer. The copy's tracks have their own lists of
+        note events and their own loop state, and the copy generates rhythms
+        with its own copies of the Markov chains, so it can be rendered in
+        another thread while this sequencer keeps playing.
+        """
+        renderer = copy(self)
+        renderer.tracks = []
+        renderer.track_indices = {}
+        renderer.groups = {}
+        renderer.event_heap = []
+        renderer.timing = TimingStats()
+        renderer.chain_cache = self.chain_cache.copy()
+        renderer.compiled_chain = self.compiled_chain.copy()
+
+        for track in self.tracks:
+            track_copy = copy(track)
+            track_copy.chain = None if track.chain is None else track.chain.copy()
+            track_copy.timestamps = track.timestamps[:]
+            track_copy.durations = track.durations[:]
+            track_copy.velocities = track.velocities[:]
+            renderer.register_track(track_copy)
+
+        return renderer
+
+    def apply_render_command(self, command):
+        """
+        Apply a command while rendering. Only the commands that change the
+        rhythm or tempo are supported.
+        """
+        if command[0] == "bpm":
+            self.set_bpm(command[1])
+        elif command[0] == "regen":
+            self.regenerate_rhythm(command[1])
+        elif command[0] == "modulate":
+            self.metric_modulation()
+        else:
+            raise Exception('Command "{}" can not be rendered.'.format(command[0]))
+
+    def render(self, file_name, bars, commands=None):
+        """
+        Render the given number of bars to a WAV file, as fast as possible
+        instead of in real time. Rendering starts at the beginning of the
+        current rhythm and does not affect playback. It works on a copy of
+        the sequencer (see copy_for_rendering), made in the calling thread, so
+        while playing it should be called on a copy obtained with the
+        "render" command instead. commands maps bar numbers
+        (starting at 0) to lists of commands, such as ("bpm", 140),
+        ("regen", "all") or ("modulate",), which are applied at the start of
+        that bar. Changes to the rhythm take effect at the end of a track's
+        loop, like they do while playing.
+        """
+        commands = commands or {}
+        renderer = self.copy_for_rendering()
+        renderer.reset_schedule()
+        samples = [track.audio_file.get_array() for track in self.tracks]
+        events = []
+        bar_start_index = 0
+        bar_start_time = 0
+
+        for bar in range(bars):
+            for command in commands.get(bar, []):
+                renderer.apply_render_command(command)
+
+            bar_end_index = bar_start_index + renderer.get_sequence_length()
+
+            # The next loops of the tracks that end with this bar are
+            # scheduled after the next bar's commands are applied.
+            while renderer.event_heap[0][0] < bar_end_index - REFILL_AHEAD:
+                index, track_index, note_event = heappop(renderer.event_heap)
+
+                if note_event is None:
+                    renderer.tracks[track_index].end_bar()
+                    renderer.schedule_bar(track_index)
+                    continue
+
+                if note_event.velocity == 0:
+                    continue
+
+                # The tempo only changes at the start of a bar, so the time of
+                # an event follows from the start of its bar.
+                event_time = (
+                    bar_start_time
+                    + (index - bar_start_index) * renderer.sixteenth_duration
+                )
+                events.append(
+                    (
+                        round(event_time * SAMPLE_RATE),
+                        samples[track_index],
+                        velocity_to_gain(note_event.velocity),
+                    )
+                )
+
+            bar_start_time += (
+                bar_end_index - bar_start_index
+            ) * renderer.sixteenth_duration
+            bar_start_index = bar_end_index
+
+        buffer = mix(events, round(bar_start_time * SAMPLE_RATE))
+        write_wave_file(file_name, buffer)
 
     def handle_command(self, command):
         """
@@ -370,36 +765,185 @@ class Sequencer:
             self.export_midi(command[1])
         elif command[0] == "modulate":
             self.metric_modulation()
+            self.queue_outgoing.put_nowait("done")
+        elif command[0] == "keep":
+            self.keep_rhythm()
+        elif command[0] == "add_track":
+            self.start_track(command[1])
+        elif command[0] == "render":
+            # Reply with a copy to render, so rendering doesn't hold up
+            # playback and the copy is made between events.
+            self.queue_outgoing.put_nowait(self.copy_for_rendering())
 
-    def get_command(self):
+    def start_mixer(self):
         """
-        Get a command from the queue.
+        Start streaming audio through the mixer. If no audio device can be
+        opened, play every note with simpleaudio instead.
+        """
+        if self.mixer is not None and not self.mixer.start():
+            self.mixer = None
+
+            for track in self.tracks:
+                track.prepare_velocities(track.velocities)
+
+    def get_command(self, timeout):
+        """
+        Get a command from the queue. Wait at most timeout seconds for a
+        command to arrive, or indefinitely if timeout is None. Return None if
+        no command arrived in time.
         """
         try:
-            return self.queue_incoming.get(block=False)
-        except:
+            return self.queue_incoming.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def schedule_bar(self, track_index):
+        """
+        Add the note events of the given track's current loop to the event
+        heap, followed by the point at which its next loop is scheduled (see
+        REFILL_AHEAD). Events are ordered by the sixteenth at which they
+        should be played.
+        """
+        track = self.tracks[track_index]
+
+        # Notes past the end of the track's loop are not played.
+        for index in range(bisect_left(track.timestamps, track.length)):
+            heappush(
+                self.event_heap,
+                (
+                    track.bar_start + track.timestamps[index],
+                    track_index,
+                    track.get_note(index),
+                ),
+            )
+
+        # Scheduling the next loop is an event without a note.
+        heappush(
+            self.event_heap,
+            (track.bar_start + track.length - REFILL_AHEAD, track_index, None),
+        )
+
+    def reset_schedule(self):
+        """
+        Start all tracks at the first sixteenth and schedule their first loop.
+        """
+        self.event_heap = []
+        self.play_index = 0
+
+        for track_index, track in enumerate(self.tracks):
+            track.bar_start = 0
+            self.schedule_bar(track_index)
+
+    def get_next_deadline(self):
+        """
+        Return the time at which the next event should be played, or None if
+        there are no events.
+        """
+        if len(self.event_heap) == 0:
             return None
 
+        return self.start_time + self.event_heap[0][0] * self.sixteenth_duration
+
+    def play_events(self, deadline):
+        """
+        Play all events scheduled at the first sixteenth in the event heap,
+        or schedule the next loops of the tracks whose loops are about to end.
+        The deadline is the time at which the events should have been played,
+        which is used to measure timing.
+        """
+        index = self.event_heap[0][0]
+
+        # Loops are scheduled between ticks, which are not timed.
+        if self.event_heap[0][2] is None:
+            while len(self.event_heap) > 0 and self.event_heap[0][0] == index:
+                track_index = heappop(self.event_heap)[1]
+                self.tracks[track_index].end_bar()
+                self.schedule_bar(track_index)
+
+            return
+
+        self.timing.tick(deadline, time.monotonic(), self.sixteenth_duration)
+
+        while len(self.event_heap) > 0 and self.event_heap[0][0] == index:
+            note_event = heappop(self.event_heap)[2]
+            note_event.play(deadline)
+            self.timing.record(note_event.track.name, deadline, time.monotonic())
+
+        self.play_index = index + 1
+
     def start(self):
         """
         Starts the sequencer's main loop. This loop handles both incoming
-        commands and correctly timing each track's events.
+        commands and correctly timing each track's events. The events of all
+        tracks are kept in a single heap ordered by time, which is refilled
+        one loop of a track at a time. Until the deadline of the next event,
+        the loop sleeps while waiting for a command, so it only wakes up for
+        events that have to be played or as soon as a command arrives.
         """
-        self.start_time = time.time()
-        self.play_index = 0
+        self.start_mixer()
+
+        # Stop all sound, even if the loop is interrupted or cancelled.
+        try:
+            self.start_time = time.monotonic()
+            self.reset_schedule()
+            self.timing = TimingStats()
+
+            while not self.done_playing:
+                self.timing.loop_iterations += 1
+                deadline = self.get_next_deadline()
+                timeout = None if deadline is None else deadline - time.monotonic()
+
+                if timeout is None or timeout > 0:
+                    self.handle_command(self.get_command(timeout))
+                    continue
+
+                self.play_events(deadline)
+        finally:
+            self.stop_audio()
+
+    def stop_audio(self):
+        """
+        Stop all sounds that are playing and the mixer's audio stream.
+        """
+        self.voices.stop_all()
 
-        while not self.done_playing:
-            time_since_start = time.time() - self.start_time
-            command = self.get_command()
-            self.handle_command(command)
+        if self.mixer is not None:
+            self.mixer.stop()
 
-            if time_since_start - self.play_index * self.sixteenth_duration > 0:
-                for track in self.tracks:
-                    track.step()
+    async def start_async(self):
+        """
+        Run the sequencer's main loop as a coroutine, as an alternative to
+        start. Here, queue_incoming should be an asyncio.Queue. The loop
+        awaits the next event's deadline or the next command, whichever comes
+        first, so many sequencers can share a single event loop.
+        """
+        self.start_mixer()
 
-                self.play_index += 1
-            else:
-                time.sleep(0.001)
+        # Stop all sound, even if the loop is interrupted or cancelled.
+        try:
+            self.start_time = time.monotonic()
+            self.reset_schedule()
+            self.timing = TimingStats()
+
+            while not self.done_playing:
+                self.timing.loop_iterations += 1
+                deadline = self.get_next_deadline()
+                timeout = None if deadline is None else deadline - time.monotonic()
+
+                if timeout is None or timeout > 0:
+                    try:
+                        command = await asyncio.wait_for(
+                            self.queue_incoming.get(), timeout
+                        )
+                    except asyncio.TimeoutError:
+                        continue
+
+                    self.handle_command(command)
+                    continue
+
+                self.play_events(deadline)
+        finally:
+            self.stop_audio()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+timing.py:
+Contains a class to measure how accurately the sequencer plays its notes.
+"""
+import numpy as np
+import time
+from array import array
+
+# Upper bounds in milliseconds of the buckets of the lateness histogram.
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 20]
+
+
+class TimingStats:
+    """
+    Timing stats record when each track's notes should have been played and
+    when they actually were. The times are stored in preallocated ring
+    buffers, so recording an onset doesn't allocate memory. The main loop's
+    iterations and ticks that were played more than a sixteenth late (missed
+    ticks) are counted as well.
+    """
+
+    def __init__(self, size=4096):
+        """
+        Initialize empty stats that keep the last size onsets of every track.
+        """
+        self.size = size
+        self.scheduled = {}
+        self.actual = {}
+        self.counts = {}
+        self.start_time = time.monotonic()
+        self.loop_iterations = 0
+        self.missed_ticks = 0
+
+    def __str__(self):
+        """
+        Return the stats as a string.
+        """
+        return self.summary()
+
+    def record(self, track_name, scheduled_time, actual_time):
+        """
+        Record an onset of the given track.
+        """
+        if track_name not in self.counts:
+            self.scheduled[track_name] = array("d", [0.0]) * self.size
+            self.actual[track_name] = array("d", [0.0]) * self.size
+            self.counts[track_name] = 0
+
+        index = self.counts[track_name] % self.size
+        self.scheduled[track_name][index] = scheduled_time
+        self.actual[track_name][index] = actual_time
+        self.counts[track_name] += 1
+
+    def tick(self, scheduled_time, actual_time, sixteenth_duration):
+        """
+        Count a tick as missed if it is played more than a sixteenth late.
+        """
+        if actual_time - scheduled_time > sixteenth_duration:
+            self.missed_ticks += 1
+
+    def lateness(self, track_name):
+        """
+        Return a NumPy array with the lateness in milliseconds of the recorded
+        onsets of the given track.
+        """
+        n = min(self.counts[track_name], self.size)
+        scheduled = np.frombuffer(self.scheduled[track_name])[:n]
+        actual = np.frombuffer(self.actual[track_name])[:n]
+        return (actual - scheduled) * 1000
+
+    def histogram(self, lateness):
+        """
+        Return a string with a histogram of the given lateness values.
+        """
+        counts = np.histogram(lateness, [0] + HISTOGRAM_BUCKETS + [np.inf])[0]
+        lines = []
+        lower = 0
+
+        for upper, count in zip(HISTOGRAM_BUCKETS + [np.inf], counts):
+            lines.append(
+                "  {:>5}-{:<5}ms {:>7} {}".format(
+                    lower, upper, count, "#" * int(50 * count / len(lateness))
+                )
+            )
+            lower = upper
+
+        return "\n".join(lines)
+
+    def summary(self):
+        """
+        Return the p50, p99 and maximum lateness of every track, a histogram
+        of the lateness of all tracks, the number of missed ticks and the
+        number of loop iterations per second.
+        """
+        lines = []
+        all_lateness = []
+
+        for track_name in self.counts:
+            lateness = self.lateness(track_name)
+            all_lateness.append(lateness)
+            lines.append(
+                "{}: {} onsets, lateness p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms".format(
+                    track_name,
+                    len(lateness),
+                    np.percentile(lateness, 50),
+                    np.percentile(lateness, 99),
+                    lateness.max(),
+                )
+            )
+
+        if len(all_lateness) > 0:
+            lines.append("Lateness histogram:")
+            lines.append(self.histogram(np.concatenate(all_lateness)))
+        else:
+            lines.append("No onsets recorded yet.")
+
+        duration = time.monotonic() - self.start_time
+        lines.append("Missed ticks: {}".format(self.missed_ticks))
+        lines.append(
+            "Loop iterations per second: {:.1f}".format(self.loop_iterations / duration)
+        )
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print("Please run from main.py.")
@@ -0,0 +1,66 @@
+"""
+Author:     Coen Konings
+Date:       October 17, 2026
+
+voices.py:
+Contains a class that limits the number of sounds that play at the same time.
+"""
+from collections import deque
+
+# The default maximum number of voices of a sequencer and of each track.
+MAX_VOICES = 32
+MAX_TRACK_VOICES = 8
+
+
+class VoicePool:
+    """
+    A voice pool keeps track of the sounds (voices) that are playing, such as
+    simpleaudio play objects or mixer voices. Any object with a stop and an
+    is_playing method can be used as a voice. When more than max_voices
+    voices are playing, the oldest voices are stopped (stolen) to make room
+    for new ones.
+    """
+
+    def __init__(self, max_voices):
+        """
+        Initialize an empty voice pool that plays at most max_voices voices.
+        """
+        self.max_voices = max_voices
+        self.voices = deque()
+
+    def __len__(self):
+        """
+        Return the number of voices in the pool, including voices that have
+        finished playing since the pool was last cleaned up.
+        """
+        return len(self.voices)
+
+    def remove_finished(self):
+        """
+        Remove the voices that have finished playing.
+        """
+        self.voices = deque(voice for voice in self.voices if voice.is_playing())
+
+    def add(self, voice):
+        """
+        Add a voice that has just started playing. If that makes the pool
+        exceed its limit, stop the oldest voices.
+        """
+        self.voices.append(voice)
+
+        if len(self.voices) > self.max_voices:
+            self.remove_finished()
+
+        while len(self.voices) > self.max_voices:
+            self.voices.popleft().stop()
+
+    def stop_all(self):
+        """
+        Stop all voices in the pool.
+        """
+        while len(self.voices) > 0:
+            self.voices.popleft().stop()
+
+
+if __name__ == "__main__":
+    print("Please run from main.py.")
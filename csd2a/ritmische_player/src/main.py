@@ -13,8 +13,42 @@ played can be entered. The program then plays the rhythm using the given
 sample.
 """
 import simpleaudio as sa
+from collections import OrderedDict
 from time import sleep
-from os.path import isfile
+from os.path import getmtime, isfile
+
+# Loaded samples, keyed by path and modification time, in order of use.
+wave_objects = OrderedDict()
+MAX_CACHE_SIZE = 64 * 1024 * 1024  # Bytes of audio kept in wave_objects.
+
+
+def load_wave_object(sample_path):
+    """
+    Return the WaveObject of the given sample. Samples are only read from disk
+    the first time they are played, or when their file has changed. When the
+    cached audio takes up more than MAX_CACHE_SIZE bytes, the least recently
+    used samples are removed.
+    """
+    key = (sample_path, getmtime(sample_path))
+
+    if key in wave_objects:
+        wave_objects.move_to_end(key)
+        return wave_objects[key]
+
+    # Remove samples loaded from an older version of the file.
+    for old_key in [old_key for old_key in wave_objects if old_key[0] == sample_path]:
+        del wave_objects[old_key]
+
+    wave_objects[key] = sa.WaveObject.from_wave_file(sample_path)
+
+    while (
+        len(wave_objects) > 1
+        and sum(len(wave_obj.audio_data) for wave_obj in wave_objects.values())
+        > MAX_CACHE_SIZE
+    ):
+        wave_objects.popitem(last=False)
+
+    return wave_objects[key]
 
 
 def play_sound(duration=-1, sample_path="../samples/plokrkr.wav"):
@@ -22,7 +56,7 @@ def play_sound(duration=-1, sample_path="../samples/plokrkr.wav"):
     Play sample.wav once. Wait until playback has finished.
     """
     # From https://simpleaudio.readthedocs.io/en/latest/
-    wave_obj = sa.WaveObject.from_wave_file(sample_path)
+    wave_obj = load_wave_object(sample_path)
     play_obj = wave_obj.play()
 
     if duration >= 0: